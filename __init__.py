@@ -1,7 +1,7 @@
 from .lpp.ui.comfy import ComfyDerpibooru, LPPLoaderDerpibooru
 from .lpp.ui.comfy import ComfyE621, LPPLoaderE621
 from .lpp.ui.comfy import ComfyDanbooru, LPPLoaderDanbooru
-from .lpp.ui.comfy import LPPSaver, LPPDeleter
+from .lpp.ui.comfy import LPPSaver, LPPDeleter, LPPMixer, LPPBatchPrompts
 
 
 NODE_CLASS_MAPPINGS = {
@@ -12,7 +12,9 @@ NODE_CLASS_MAPPINGS = {
     "LPP_Loader_Derpibooru": LPPLoaderDerpibooru,
     "LPP_Loader_E621": LPPLoaderE621,
     "LPP_Loader_Danbooru": LPPLoaderDanbooru,
-    "LPP_Deleter": LPPDeleter
+    "LPP_Deleter": LPPDeleter,
+    "LPP_Mixer": LPPMixer,
+    "LPP_Batch_Prompts": LPPBatchPrompts
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
@@ -23,7 +25,9 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "LPP_Loader_Derpibooru": "Tag Data Loader (Derpibooru)",
     "LPP_Loader_E621": "Tag Data Loader (E621)",
     "LPP_Loader_Danbooru": "Tag Data Loader (Danbooru)",
-    "LPP_Deleter": "Tag Data Deleter"
+    "LPP_Deleter": "Tag Data Deleter",
+    "LPP_Mixer": "Collection Mixer",
+    "LPP_Batch_Prompts": "Batch Prompts"
 }
 
 __all__ = [NODE_CLASS_MAPPINGS]
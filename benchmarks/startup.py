@@ -0,0 +1,96 @@
+from os import path
+import argparse
+import statistics
+import subprocess
+import sys
+
+LPP_ROOT_DIR = path.abspath(path.join(path.dirname(__file__), ".."))
+
+# every snippet runs in a fresh interpreter, so nothing is already imported
+# and the time measured is what ComfyUI/A1111 would pay when loading LPP
+COMFY_NODES = """
+import importlib.util, sys, time
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location(
+    "lpp_nodes", r"{root}/__init__.py", submodule_search_locations=[r"{root}"]
+)
+module = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = module
+spec.loader.exec_module(module)
+print(time.perf_counter() - start)
+"""
+
+COMFY_FIRST_USE = """
+import sys, time
+sys.path.insert(0, r"{root}")
+import lpp.ui.comfy as comfy
+start = time.perf_counter()
+comfy.get_lpp_sources()
+comfy.get_cache_manager()
+print(time.perf_counter() - start)
+"""
+
+A1111_BACKEND = """
+import sys, time
+sys.path.insert(0, r"{root}")
+start = time.perf_counter()
+from lpp.ui.a1111 import LPP_A1111
+LPP_A1111(r"{root}")
+print(time.perf_counter() - start)
+"""
+
+A1111_EXTENSION = """
+import runpy, sys, time
+sys.path.insert(0, r"{root}")
+import modules.scripts
+start = time.perf_counter()
+runpy.run_path(r"{root}/scripts/lpp_extension.py")
+print(time.perf_counter() - start)
+"""
+
+BENCHMARKS = {
+    "ComfyUI nodes import (__init__.py)": COMFY_NODES,
+    "ComfyUI first use (sources + tag cache)": COMFY_FIRST_USE,
+    "A1111 backend import + LPP_A1111()": A1111_BACKEND,
+    "A1111 extension import (scripts/lpp_extension.py)": A1111_EXTENSION,
+}
+
+
+def run(snippet: str, runs: int) -> list[float]:
+    times = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", snippet.format(root=LPP_ROOT_DIR)],
+            capture_output=True,
+            text=True
+        )
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()
+            raise RuntimeError(error[-1] if error else "failed")
+        times.append(float(result.stdout.strip().splitlines()[-1]))
+    return times
+
+
+def main(argv: list[str] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python benchmarks/startup.py",
+        description="Measure how much LPP adds to ComfyUI and A1111 startup"
+    )
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    for name, snippet in BENCHMARKS.items():
+        try:
+            times = run(snippet, args.runs)
+        except RuntimeError as e:
+            # the A1111 extension can only be imported from inside webui
+            print(f"{name}: skipped ({e})")
+            continue
+        print(
+            f"{name}: median {statistics.median(times) * 1000:.1f} ms, "
+            f"min {min(times) * 1000:.1f} ms ({args.runs} runs)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+from lpp.data import TagData, TagGroups
+from collections import Counter
+from heapq import nlargest
+from itertools import chain, combinations
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# upper bound of tag pairs expanded at once by the numpy builder
+PAIRS_PER_BATCH = 4000000
+
+
+class TagCooccurrence:
+    # Sparse, symmetric tag co-occurrence counts over the vocab_size most
+    # frequent tags of a collection, stored CSR style: the neighbours of tag
+    # i are indices[indptr[i]:indptr[i + 1]] with their pair counts in
+    # counts[...]. Only pairs that actually occur are ever stored.
+    def __init__(self,
+                 tag_data: TagData,
+                 source: object,
+                 vocab_size: int = 2000):
+        categories = [x for x in TagGroups.get_categories() if x != "rating"]
+        tag_lists = []
+        for raw_tags in tag_data.raw_tags:
+            groups = source._convert_raw_tags(raw_tags)
+            # dict.fromkeys dedups in tag order; with a set, which tags
+            # make the vocab on tied counts would depend on PYTHONHASHSEED
+            tag_lists.append(dict.fromkeys(
+                x for c in categories for x in getattr(groups, c)
+            ))
+
+        frequencies = Counter(chain.from_iterable(tag_lists))
+        self.__vocab: list[str] = [
+            x for x, _ in frequencies.most_common(vocab_size)
+        ]
+        self.__ids: dict[str:int] = {x: i for i, x in enumerate(self.__vocab)}
+        self.__tag_counts: list[int] = [frequencies[x] for x in self.__vocab]
+        self.__posts: int = len(tag_lists)
+        self.__query: str = tag_data.query
+        self.__edges: tuple = (tag_data.raw_tags[0], tag_data.raw_tags[-1]) \
+            if tag_data.raw_tags else None
+        posts = [
+            sorted(self.__ids[x] for x in tags if x in self.__ids)
+            for tags in tag_lists
+        ]
+        build = self.__build_numpy if np is not None else self.__build_python
+        self.__indptr, self.__indices, self.__counts = build(posts)
+
+    def __build_python(self, posts: list[list[int]]) -> tuple[list, list, list]:
+        pairs = Counter(chain.from_iterable(combinations(x, 2) for x in posts))
+        rows = [[] for _ in self.__vocab]
+        for (i, j), n in pairs.items():
+            rows[i].append((j, n))
+            rows[j].append((i, n))
+        indptr, indices, counts = [0], [], []
+        for row in rows:
+            row.sort()
+            indices += [x for x, _ in row]
+            counts += [n for _, n in row]
+            indptr.append(len(indices))
+        return indptr, indices, counts
+
+    def __build_numpy(self, posts: list[list[int]]) -> tuple:
+        size = len(self.__vocab)
+        lengths = np.fromiter(map(len, posts), dtype=np.int64,
+                              count=len(posts))
+        flat = np.fromiter(chain.from_iterable(posts), dtype=np.int64,
+                           count=int(lengths.sum()))
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+        keys, counts = [], []
+        # posts with the same number of tags expand into pairs with one
+        # fancy indexing operation; tags in a post are sorted, so the pair
+        # key i * size + j always has i < j
+        for m in np.unique(lengths):
+            if m < 2:
+                continue
+            starts = offsets[lengths == m]
+            i, j = np.triu_indices(m, 1)
+            batch = max(PAIRS_PER_BATCH // len(i), 1)
+            for b in range(0, len(starts), batch):
+                rows = flat[starts[b:b + batch, None] + np.arange(m)]
+                pair_keys, pair_counts = np.unique(
+                    (rows[:, i] * size + rows[:, j]).ravel(),
+                    return_counts=True
+                )
+                keys.append(pair_keys)
+                counts.append(pair_counts)
+
+        if not keys:
+            return np.zeros(size + 1, dtype=np.int64), \
+                np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+        counts = np.bincount(
+            inverse, weights=np.concatenate(counts)
+        ).astype(np.int64)
+
+        # mirror the upper triangle and sort it into rows
+        rows = np.concatenate((keys // size, keys % size))
+        cols = np.concatenate((keys % size, keys // size))
+        counts = np.concatenate((counts, counts))
+        order = np.lexsort((cols, rows))
+        indptr = np.concatenate(
+            ([0], np.cumsum(np.bincount(rows, minlength=size)))
+        )
+        return indptr, cols[order], counts[order]
+
+    @property
+    def vocab(self) -> list[str]:
+        return list(self.__vocab)
+
+    def is_up_to_date(self, tag_data: TagData) -> bool:
+        # like TagStats, the first and last prompts catch a collection
+        # overwritten with one of the same length and query
+        if self.__posts != len(tag_data.raw_tags) \
+                or self.__query != tag_data.query:
+            return False
+        return not tag_data.raw_tags \
+            or self.__edges == (tag_data.raw_tags[0], tag_data.raw_tags[-1])
+
+    def __row(self, tag: str) -> tuple[int, list[tuple[int, int]]]:
+        if tag not in self.__ids:
+            raise KeyError(f"\"{tag}\" is not among the collection's top tags")
+        i = self.__ids[tag]
+        start, end = int(self.__indptr[i]), int(self.__indptr[i + 1])
+        return i, zip(self.__indices[start:end], self.__counts[start:end])
+
+    def count(self, tag: str, other: str) -> int:
+        _, row = self.__row(tag)
+        j = self.__ids.get(other)
+        return next((int(n) for x, n in row if x == j), 0)
+
+    def top(self, tag: str, k: int = 10) -> list[tuple[str, int]]:
+        _, row = self.__row(tag)
+        return [
+            (self.__vocab[x], int(n))
+            for x, n in nlargest(k, row, key=lambda x: x[1])
+        ]
+
+    def pmi(self,
+            tag: str,
+            k: int = 10,
+            min_count: int = 3) -> list[tuple[str, float]]:
+        # pointwise mutual information, log(p(x, y) / (p(x) * p(y))), ranks
+        # tags that show up with X much more often than chance; min_count
+        # keeps rare tags from topping the list by coincidence
+        i, row = self.__row(tag)
+        tag_counts, posts = self.__tag_counts, self.__posts
+        scores = [
+            (self.__vocab[x],
+             math.log(n * posts / (tag_counts[i] * tag_counts[x])))
+            for x, n in row if n >= min_count
+        ]
+        return nlargest(k, scores, key=lambda x: x[1])
@@ -2,10 +2,14 @@ from abc import ABC, abstractmethod
 from copy import deepcopy
 from dataclasses import dataclass, fields, asdict
 from lpp.log import get_logger
-from os import path
+from os import path, makedirs, remove
 import enum
 import fnmatch
+import hashlib
+import json
 import pickle
+import re
+import threading
 
 logger = get_logger()
 
@@ -16,6 +20,7 @@ class TagData:
     query: str
     raw_tags: list
     other_params: dict
+    post_ids: list = None
 
 
 @dataclass
@@ -128,10 +133,103 @@ class RenameUnpickler(pickle.Unpickler):
         return super(RenameUnpickler, self).find_class(renamed_module, name)
 
 
+class FetchCheckpoint:
+    # Append-only log of fetched pages. The first record is the (empty)
+    # TagData header, every following record is a (next_page, raw_tags,
+    # post_ids) tuple, so writing a page never rewrites what was already
+    # saved.
+    def __init__(self,
+                 tag_data: TagData,
+                 query_params: dict[str:object],
+                 work_dir: str = "."):
+        # the random seed is left out of the key: every unseeded random
+        # fetch gets a fresh seed, so its checkpoint could otherwise never
+        # be found again and would just pile up in partial_fetches
+        key = json.dumps(
+            [tag_data.source, self.__strip_seed(tag_data.query),
+             {k: v for k, v in tag_data.other_params.items()
+              if k != "random_seed"},
+             {k: self.__strip_seed(v) for k, v in query_params.items()
+              if k not in ["page", "key"]}],
+            sort_keys=True, default=str
+        )
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        self._dir = path.join(work_dir, "partial_fetches")
+        self._file = path.join(
+            self._dir, f"{tag_data.source.lower()}_{digest}.dat"
+        )
+        self._header = TagData(
+            tag_data.source, tag_data.query, [], deepcopy(tag_data.other_params)
+        )
+
+    @staticmethod
+    def __strip_seed(value: object) -> str:
+        return re.sub(r"(random:|randseed:)\d+", r"\1", str(value))
+
+    def get_random_seed(self) -> int:
+        if not path.exists(self._file):
+            return None
+        try:
+            with open(self._file, "rb") as f:
+                return pickle.load(f).other_params.get("random_seed")
+        except Exception:
+            return None
+
+    def load(self, first_page: object = 1) -> tuple[list, list, object]:
+        raw_tags = []
+        post_ids = []
+        next_page = first_page
+        if not path.exists(self._file):
+            return raw_tags, post_ids, next_page
+
+        truncated = stale = False
+        with open(self._file, "rb") as f:
+            try:
+                header = pickle.load(f)
+                # pages of another random order can't be continued, so a
+                # fetch with a different seed replaces the stale one
+                stale = header.other_params.get("random_seed") \
+                    != self._header.other_params.get("random_seed")
+                while not stale:
+                    next_page, page_tags, page_ids = pickle.load(f)
+                    raw_tags += page_tags
+                    post_ids += page_ids
+            except EOFError:
+                pass
+            except Exception:
+                # a page that was being written when the process died
+                logger.warning(
+                    "Discarding truncated page in partial fetch file"
+                )
+                truncated = True
+        if stale:
+            self.delete()
+        elif truncated:
+            self.delete()
+            self.save_page(next_page, raw_tags, post_ids)
+        return raw_tags, post_ids, next_page
+
+    def save_page(self,
+                  next_page: object,
+                  raw_tags: list,
+                  post_ids: list) -> None:
+        if not path.exists(self._file):
+            makedirs(self._dir, exist_ok=True)
+            with open(self._file, "wb") as f:
+                pickle.dump(self._header, f)
+        with open(self._file, "ab") as f:
+            pickle.dump((next_page, raw_tags, post_ids), f)
+
+    def delete(self) -> None:
+        if path.exists(self._file):
+            remove(self._file)
+
+
 class LppDataManager(ABC):
     def __init__(self, cache_file: str, work_dir: str = "."):
         self._cache_file = cache_file
         self._work_dir: str = work_dir
+        self._lock = threading.RLock()  # fetch jobs save from other threads
         self._data: dict[str:object] = self._load_cache()
 
     def __getitem__(self, name: str) -> object:
@@ -139,6 +237,12 @@ class LppDataManager(ABC):
             raise KeyError(f"No name '{name}' in cache")
         return deepcopy(self._data[name])
 
+    def peek(self, name: str) -> object:
+        # read-only access that skips the copy, for callers that only look
+        if name not in self._data:
+            raise KeyError(f"No name '{name}' in cache")
+        return self._data[name]
+
     def _load_cache(self) -> dict[str:object]:
         cache_file = path.join(self._work_dir, self._cache_file)
         if not path.exists(cache_file):
@@ -155,7 +259,7 @@ class LppDataManager(ABC):
 
     def _dump_cache(self) -> None:
         cache_file = path.join(self._work_dir, self._cache_file)
-        with open(cache_file, "wb") as f:
+        with self._lock, open(cache_file, "wb") as f:
             pickle.dump(self._data, f)
 
     @abstractmethod
@@ -176,10 +280,11 @@ class LppDataManager(ABC):
         return list(self._data.keys())
 
     def delete_item(self, name: str) -> None:
-        if name not in self._data:
-            raise KeyError(f"No name '{name}' in cache")
-        del self._data[name]
-        self._dump_cache()
+        with self._lock:
+            if name not in self._data:
+                raise KeyError(f"No name '{name}' in cache")
+            del self._data[name]
+            self._dump_cache()
 
 
 class CacheManager(LppDataManager):
@@ -195,8 +300,9 @@ class CacheManager(LppDataManager):
         new_item = deepcopy(data)
         new_item.other_params["filters"] = deepcopy(filters) if filters else []
 
-        self._data[name] = new_item
-        self._dump_cache()
+        with self._lock:
+            self._data[name] = new_item
+            self._dump_cache()
 
     def export_data(self) -> dict[str:dict[str:object]]:
         return {k: asdict(v) for k, v in self._data.items()}
@@ -209,6 +315,85 @@ class CacheManager(LppDataManager):
                 success_count += 1
         return success_count
 
+    @staticmethod
+    def __get_item_keys(items: list[TagData],
+                        by_id: bool) -> list[list[object]]:
+        if by_id:
+            return [x.post_ids for x in items]
+        return [
+            [hashlib.sha1(
+                json.dumps(t, sort_keys=True).encode("utf-8")
+            ).hexdigest() for t in x.raw_tags]
+            for x in items
+        ]
+
+    def combine(self, operation: str, names: list[str]) -> TagData:
+        if operation not in ["union", "intersection", "difference"]:
+            raise ValueError(f"Unknown operation \"{operation}\"")
+        if len(names) < 2:
+            raise ValueError("At least two collections are needed")
+        with self._lock:
+            items = [self.peek(x) for x in names]
+            if len({x.source for x in items}) > 1:
+                raise ValueError(
+                    "Can't combine collections from different sources"
+                )
+            # posts are matched by id when every collection has them,
+            # otherwise by a hash of their tags, as mixing the two would
+            # never match anything
+            has_ids = all(x.post_ids and len(x.post_ids) == len(x.raw_tags)
+                          for x in items)
+            keys = self.__get_item_keys(items, has_ids)
+
+            seen = set()
+            if operation == "union":
+                sources = list(zip(items, keys))
+            else:
+                others = [set(x) for x in keys[1:]]
+                sources = [(items[0], keys[0])]
+            raw_tags, post_ids = [], []
+            for item, item_keys in sources:
+                for i, key in enumerate(item_keys):
+                    if key in seen:
+                        continue
+                    if operation == "intersection" \
+                            and not all(key in x for x in others):
+                        continue
+                    if operation == "difference" \
+                            and any(key in x for x in others):
+                        continue
+                    seen.add(key)
+                    raw_tags.append(item.raw_tags[i])
+                    if has_ids:
+                        post_ids.append(item.post_ids[i])
+
+            return TagData(
+                items[0].source,
+                f"{operation}({', '.join(names)})",
+                deepcopy(raw_tags),
+                {
+                    "lineage": {
+                        "operation": operation,
+                        "collections": list(names),
+                        "queries": [x.query for x in items]
+                    },
+                    "filters": list(dict.fromkeys(
+                        f for x in items
+                        for f in x.other_params.get("filters", [])
+                    ))
+                },
+                post_ids if has_ids else None
+            )
+
+    def union(self, *names: str) -> TagData:
+        return self.combine("union", names)
+
+    def intersection(self, *names: str) -> TagData:
+        return self.combine("intersection", names)
+
+    def difference(self, *names: str) -> TagData:
+        return self.combine("difference", names)
+
 
 class FiltersManager(LppDataManager):
     def __init__(self, work_dir: str = "."):
@@ -218,8 +403,9 @@ class FiltersManager(LppDataManager):
         if not name:
             raise ValueError("Empty \"name\" parameter")
         new_item = deepcopy(data)
-        self._data[name] = new_item
-        self._dump_cache()
+        with self._lock:
+            self._data[name] = new_item
+            self._dump_cache()
 
     def export_data(self) -> dict[str:str]:
         return {k: str(v) for k, v in self._data.items()}
@@ -0,0 +1,165 @@
+from lpp.data import TagData
+from copy import deepcopy
+from itertools import chain
+import random
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+class NearDuplicateFinder:
+    # MinHash signatures + LSH banding over the tag sets of posts. Posts
+    # whose signatures agree on a whole band land in the same bucket, and
+    # only those candidates get their exact Jaccard similarity checked, so
+    # the collection is never compared pairwise.
+    MAX_BUCKET_REPRESENTATIVES = 8
+
+    def __init__(self,
+                 threshold: float = 0.8,
+                 num_perm: int = 64,
+                 seed: int = 1):
+        if not 0 < threshold <= 1:
+            raise ValueError("Similarity threshold must be in (0, 1]")
+        self.threshold = threshold
+        rng = random.Random(seed)
+        self.__perms = [
+            (rng.randrange(1, MERSENNE_PRIME), rng.randrange(MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+        self.__bands, self.__rows = self.__get_bands(threshold, num_perm)
+        self.__tag_signatures: dict[str:tuple[int]] = {}
+        self.__tag_sets: list[set[str]] = []
+        self.__parents: list[int] = []
+        self.__buckets: dict[tuple:list[int]] = {}
+
+    @staticmethod
+    def __get_bands(threshold: float, num_perm: int) -> tuple[int, int]:
+        # pairs with similarity s become candidates with probability
+        # 1 - (1 - s^r)^b, which rises steepest around (1 / b)^(1 / r)
+        options = [(b, num_perm // b) for b in range(1, num_perm + 1)
+                   if num_perm % b == 0]
+        return min(options,
+                   key=lambda x: abs((1 / x[0]) ** (1 / x[1]) - threshold))
+
+    def __get_tag_signature(self, tag: str) -> tuple[int]:
+        # every tag is hashed only once; a post's signature is then just the
+        # element-wise minimum of its tags' signatures
+        signature = self.__tag_signatures.get(tag)
+        if signature is None:
+            x = zlib.crc32(tag.encode("utf-8"))
+            # keeping 30 bits makes every hash a single digit CPython int,
+            # which is what min() spends all its time comparing
+            signature = self.__tag_signatures[tag] = tuple(
+                ((a * x + b) % MERSENNE_PRIME) >> 31 for a, b in self.__perms
+            )
+        return signature
+
+    def get_signature(self, tags: set[str]) -> tuple[int]:
+        if not tags:
+            return ()
+        if len(tags) == 1:
+            return self.__get_tag_signature(next(iter(tags)))
+        return tuple(map(min, *map(self.__get_tag_signature, tags)))
+
+    def get_signatures(self, tag_sets: list[set[str]]) -> list[tuple[int]]:
+        non_empty = [x for x in tag_sets if x]
+        if np is None or not non_empty:
+            return [self.get_signature(x) for x in tag_sets]
+        # with numpy, a whole batch of posts is reduced at once: gather the
+        # signature rows of every tag and take the minimum per post segment
+        tag_ids = {}
+        flat = [tag_ids.setdefault(x, len(tag_ids))
+                for x in chain.from_iterable(non_empty)]
+        matrix = np.array([self.__get_tag_signature(x) for x in tag_ids],
+                          dtype=np.int64)
+        offsets = np.cumsum([0] + [len(x) for x in non_empty[:-1]])
+        minimums = iter(map(
+            tuple,
+            np.minimum.reduceat(matrix[flat], offsets, axis=0).tolist()
+        ))
+        return [next(minimums) if x else () for x in tag_sets]
+
+    def __len__(self) -> int:
+        return len(self.__tag_sets)
+
+    def __find(self, x: int) -> int:
+        parents = self.__parents
+        while parents[x] != x:
+            parents[x] = parents[parents[x]]
+            x = parents[x]
+        return x
+
+    def __is_similar(self, x: int, y: int) -> bool:
+        a, b = self.__tag_sets[x], self.__tag_sets[y]
+        union = len(a | b)
+        return union > 0 and len(a & b) / union >= self.threshold
+
+    def add(self, tags: set[str], signature: tuple[int] = None) -> int:
+        item = len(self.__tag_sets)
+        self.__tag_sets.append(tags)
+        self.__parents.append(item)
+        if signature is None:
+            signature = self.get_signature(tags)
+        for band in range(self.__bands if signature else 0):
+            key = (band,) + signature[
+                band * self.__rows:(band + 1) * self.__rows
+            ]
+            representatives = self.__buckets.setdefault(key, [])
+            # a bucket only keeps a few distinct representatives, so huge
+            # buckets of identical posts stay linear
+            for other in representatives:
+                root, other_root = self.__find(item), self.__find(other)
+                if root == other_root or self.__is_similar(other, item):
+                    self.__parents[max(root, other_root)] = \
+                        min(root, other_root)
+                    break
+            else:
+                if len(representatives) < self.MAX_BUCKET_REPRESENTATIVES:
+                    representatives.append(item)
+        return item
+
+    def update(self, tag_data: TagData, source: object):
+        # like TagIndex, only the prompts added since the last call are
+        # hashed, so a growing pool is never reprocessed
+        tag_sets = [
+            set(source.get_index_terms(x))
+            for x in tag_data.raw_tags[len(self):]
+        ]
+        for tags, signature in zip(tag_sets, self.get_signatures(tag_sets)):
+            self.add(tags, signature)
+        return self
+
+    @property
+    def representatives(self) -> list[int]:
+        # for every item, the index of the first item of its cluster
+        return [self.__find(x) for x in range(len(self.__tag_sets))]
+
+    @property
+    def unique_items(self) -> list[int]:
+        return [i for i, x in enumerate(self.representatives) if i == x]
+
+
+def deduplicate(tag_data: TagData,
+                source: object,
+                threshold: float = 0.8) -> TagData:
+    keep = NearDuplicateFinder(threshold)\
+        .update(tag_data, source)\
+        .unique_items
+    other_params = deepcopy(tag_data.other_params)
+    other_params["near_duplicates_removed"] = \
+        len(tag_data.raw_tags) - len(keep)
+    post_ids = [tag_data.post_ids[x] for x in keep] \
+        if tag_data.post_ids \
+        and len(tag_data.post_ids) == len(tag_data.raw_tags) else None
+    return TagData(
+        tag_data.source,
+        tag_data.query,
+        [tag_data.raw_tags[x] for x in keep],
+        other_params,
+        post_ids
+    )
@@ -0,0 +1,215 @@
+from lpp.data import TagData, CacheManager
+from lpp.index import TagIndex
+from lpp.log import get_logger
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from itertools import islice
+from os import path, makedirs
+import argparse
+import csv
+import gzip
+import json
+import logging
+import os
+import pickle
+import sys
+import time
+
+logger = get_logger()
+
+LPP_ROOT_DIR = path.join(path.dirname(__file__), "..")
+CHUNK_SIZE = 20000
+
+# state of a worker process, set once by _init_worker instead of being
+# pickled along with every chunk
+_worker = {}
+
+
+def _open(file: str) -> object:
+    if file.endswith(".gz"):
+        return gzip.open(file, "rt", encoding="utf-8", newline="")
+    return open(file, encoding="utf-8", newline="")
+
+
+def read_rows(file: str, fields: list[str] = None) -> object:
+    # streams rows of a CSV or JSON lines dump as dicts, only keeping the
+    # fields we actually need so chunks stay cheap to send to the workers
+    with _open(file) as f:
+        if ".csv" in path.basename(file):
+            csv.field_size_limit(2**31 - 1)  # post descriptions can be huge
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(x) for x in f if x.strip())
+        for row in rows:
+            yield {k: row.get(k) for k in fields} if fields else row
+
+
+def read_tag_categories(file: str) -> dict[str:int]:
+    return {
+        x["name"]: int(x["category"])
+        for x in read_rows(file, ["name", "category"])
+    }
+
+
+def _init_worker(source_name: str,
+                  tag_categories: dict[str:int],
+                  query: str,
+                  work_dir: str) -> None:
+    from lpp.sources.utils import get_sources
+    _worker["source"] = get_sources(work_dir)[source_name]
+    _worker["tag_categories"] = tag_categories
+    _worker["query"] = query
+
+
+def _ingest_chunk(rows: list[dict[str:object]]) -> tuple[list, list, TagIndex]:
+    source = _worker["source"]
+    post_ids, raw_tags, index = [], [], TagIndex()
+    for row in rows:
+        try:
+            post = source._parse_dump_row(row, _worker["tag_categories"])
+        except (KeyError, ValueError, AttributeError):
+            continue  # malformed row
+        if not post:
+            continue
+        post_ids.append(post["id"])
+        raw_tags.append(source._extract_raw_tags(post))
+        index.add(source.get_index_terms(raw_tags[-1]))
+
+    if not _worker["query"]:
+        return post_ids, raw_tags, index
+    docs = index.search(_worker["query"])
+    post_ids = [post_ids[x] for x in docs]
+    raw_tags = [raw_tags[x] for x in docs]
+    index = TagIndex()
+    for tags in raw_tags:
+        index.add(source.get_index_terms(tags))
+    return post_ids, raw_tags, index
+
+
+def ingest_dump(source_name: str,
+                posts_file: str,
+                tags_file: str = None,
+                query: str = "",
+                workers: int = None,
+                work_dir: str = LPP_ROOT_DIR) -> tuple[TagData, TagIndex]:
+    from lpp.sources.utils import get_sources
+    source = get_sources(work_dir)[source_name]
+    # checked up front, the workers would only find out after the dump has
+    # already been read and chunked
+    if not source.DUMP_FIELDS:
+        raise ValueError(f"{source_name} database dumps are not supported")
+    tag_categories = read_tag_categories(tags_file) if tags_file else {}
+    if not tag_categories and source_name == "E621":
+        logger.warning("No tags dump given, all tags will be \"general\"")
+
+    tag_data = TagData(
+        source_name,
+        query,
+        [],
+        {"dump": path.basename(posts_file), "dump_query": query},
+        []
+    )
+    index = TagIndex()
+    workers = workers or os.cpu_count() or 1
+    rows = read_rows(posts_file, source.DUMP_FIELDS)
+    start = time.monotonic()
+
+    def collect(result: tuple[list, list, TagIndex]) -> None:
+        post_ids, raw_tags, chunk_index = result
+        tag_data.post_ids += post_ids
+        tag_data.raw_tags += raw_tags
+        index.extend(chunk_index)
+        logger.info(
+            f"{len(index)} posts ingested "
+            f"({time.monotonic() - start:.0f}s elapsed)"
+        )
+
+    with ProcessPoolExecutor(
+        workers,
+        initializer=_init_worker,
+        initargs=(source_name, tag_categories, query, work_dir)
+    ) as executor:
+        # keep a bounded number of chunks in flight, so a dump with millions
+        # of rows is never read into memory at once
+        pending = deque()
+        while chunk := list(islice(rows, CHUNK_SIZE)):
+            pending.append(executor.submit(_ingest_chunk, chunk))
+            if len(pending) >= workers * 2:
+                collect(pending.popleft().result())
+        while pending:
+            collect(pending.popleft().result())
+    return tag_data, index
+
+
+def get_dump_file(name: str, work_dir: str = LPP_ROOT_DIR) -> str:
+    return path.join(work_dir, "dumps", f"{name}.dat")
+
+
+def save_dump(name: str,
+              tag_data: TagData,
+              index: TagIndex,
+              work_dir: str = LPP_ROOT_DIR) -> None:
+    dump_file = get_dump_file(name, work_dir)
+    makedirs(path.dirname(dump_file), exist_ok=True)
+    with open(dump_file, "wb") as f:
+        pickle.dump((tag_data, index), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_dump(name: str,
+              work_dir: str = LPP_ROOT_DIR) -> tuple[TagData, TagIndex]:
+    dump_file = get_dump_file(name, work_dir)
+    if not path.exists(dump_file):
+        raise KeyError(f"No ingested dump named '{name}'")
+    with open(dump_file, "rb") as f:
+        return pickle.load(f)
+
+
+def main(argv: list[str] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m lpp.dumps",
+        description="Build LPP prompt collections from booru database dumps"
+    )
+    parser.add_argument("-w", "--work-dir", default=LPP_ROOT_DIR)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest = commands.add_parser("ingest", help="index a posts dump")
+    ingest.add_argument("source", choices=["E621", "Danbooru"])
+    ingest.add_argument("posts_file", help="posts CSV or JSON lines dump")
+    ingest.add_argument("name", help="name to save the ingested dump under")
+    ingest.add_argument("-t", "--tags-file",
+                        help="tags dump with the tag categories")
+    ingest.add_argument("-q", "--query", default="",
+                        help="only ingest posts matching this query")
+    ingest.add_argument("-j", "--workers", type=int)
+
+    query = commands.add_parser(
+        "query", help="save posts of an ingested dump as a collection"
+    )
+    query.add_argument("name", help="name of the ingested dump")
+    query.add_argument("query", help="tags, -negations, ~or and rating:x")
+    query.add_argument("collection", help="prompts collection to save to")
+    query.add_argument("-n", "--count", type=int)
+
+    args = parser.parse_args(argv)
+    if args.verbose:
+        logger.setLevel(logging.INFO)
+
+    if args.command == "ingest":
+        tag_data, index = ingest_dump(
+            args.source, args.posts_file, args.tags_file, args.query,
+            args.workers, args.work_dir
+        )
+        save_dump(args.name, tag_data, index, args.work_dir)
+        print(f"Ingested {len(index)} posts as \"{args.name}\"")
+    else:
+        tag_data, index = load_dump(args.name, args.work_dir)
+        result = index.select(tag_data, args.query, args.count)
+        if not result.raw_tags:
+            sys.exit("No posts match the query")
+        CacheManager(args.work_dir).save_item(args.collection, result)
+        print(f"Saved {len(result.raw_tags)} prompts as \"{args.collection}\"")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+from lpp.data import TagData
+from lpp.log import get_logger
+from array import array
+from copy import deepcopy
+import fnmatch
+import re
+
+logger = get_logger()
+
+
+class TagIndex:
+    # Inverted index from tag to the numbers of the documents that have it.
+    # Documents are numbered in insertion order, so appending keeps every
+    # posting list sorted and a plain array of ints is enough to store it.
+    TYPECODE = "I"
+    IGNORED_METATAGS = ("order:", "randseed:", "limit:")
+
+    def __init__(self):
+        self.__postings: dict[str:array] = {}
+        self.__size: int = 0
+
+    def __len__(self) -> int:
+        return self.__size
+
+    @staticmethod
+    def normalize(term: str) -> str:
+        term = term.strip().lower().replace(" ", "_")
+        if term.startswith("rating:") and len(term) > len("rating:"):
+            # rating:safe, rating:s and friends all mean the same thing
+            term = term[:len("rating:") + 1]
+        return term
+
+    def add(self, terms: list[str]) -> int:
+        doc = self.__size
+        for term in {self.normalize(x) for x in terms}:
+            postings = self.__postings.get(term)
+            if postings is None:
+                postings = self.__postings[term] = array(self.TYPECODE)
+            postings.append(doc)
+        self.__size += 1
+        return doc
+
+    def extend(self, other: "TagIndex"):
+        # appends the documents of another index after ours, which is how
+        # separately built chunks get stitched together
+        offset = self.__size
+        for term, other_postings in other.__postings.items():
+            postings = self.__postings.get(term)
+            if postings is None:
+                postings = self.__postings[term] = array(self.TYPECODE)
+            if offset:
+                postings.extend(x + offset for x in other_postings)
+            else:
+                postings.extend(other_postings)
+        self.__size += other.__size
+        return self
+
+    def update(self, tag_data: TagData, source: object):
+        # collections only ever grow at the end (see progressive fetching),
+        # so indexing whatever is past our last document is enough
+        for raw_tags in tag_data.raw_tags[self.__size:]:
+            self.add(source.get_index_terms(raw_tags))
+        return self
+
+    def get_terms(self, pattern: str = None) -> list[str]:
+        if not pattern:
+            return list(self.__postings.keys())
+        return fnmatch.filter(self.__postings.keys(), self.normalize(pattern))
+
+    def get_postings(self, term: str) -> set[int]:
+        term = self.normalize(term)
+        if any(x in term for x in ["*", "?", "["]):
+            docs = set()
+            for match in self.get_terms(term):
+                docs.update(self.__postings[match])
+            return docs
+        return set(self.__postings.get(term, ()))
+
+    def search(self, query: str) -> list[int]:
+        node = QueryParser(query).parse()
+        if node is None:
+            return list(range(self.__size))
+        return sorted(self.__evaluate(node))
+
+    def __evaluate(self, node: tuple) -> set[int]:
+        op, operand = node
+        if op == "term":
+            return self.get_postings(operand)
+        if op == "not":
+            return set(range(self.__size)) - self.__evaluate(operand)
+        if op == "or":
+            return set().union(*[self.__evaluate(x) for x in operand])
+
+        # negations are subtracted from the intersection of the rest instead
+        # of being turned into (huge) complements of their own
+        positive = [x for x in operand if x[0] != "not"]
+        negative = [x[1] for x in operand if x[0] == "not"]
+        sets = sorted([self.__evaluate(x) for x in positive], key=len)
+        docs = set.intersection(*sets) if sets else set(range(self.__size))
+        for x in negative:
+            if not docs:
+                break
+            docs -= self.__evaluate(x)
+        return docs
+
+    def select(self,
+               tag_data: TagData,
+               query: str,
+               count: int = None) -> TagData:
+        docs = self.search(query)[:count]
+        post_ids = [tag_data.post_ids[x] for x in docs] \
+            if tag_data.post_ids \
+            and len(tag_data.post_ids) == len(tag_data.raw_tags) else None
+        other_params = deepcopy(tag_data.other_params)
+        other_params["selected_from"] = tag_data.query
+        return TagData(
+            tag_data.source,
+            query,
+            [tag_data.raw_tags[x] for x in docs],
+            other_params,
+            post_ids
+        )
+
+
+class QueryParser:
+    # Turns a booru style query into a tree of ("and" | "or", [nodes]),
+    # ("not", node) and ("term", tag) tuples. Supports whitespace or comma
+    # separated tags, AND/&&, OR/||, NOT/-/!, e621 style ~or groups,
+    # parentheses and wildcards.
+    KEYWORDS = {"and": "AND", "&&": "AND", ",": "AND",
+                "or": "OR", "||": "OR", "|": "OR",
+                "not": "NOT", "!": "NOT"}
+
+    def __init__(self, query: str):
+        self.__tokens: list[tuple[str, str]] = self.__tokenize(query)
+        self.__pos: int = 0
+
+    @staticmethod
+    def __split_word(word: str) -> list[tuple[str, str]]:
+        tokens = []
+        while word and word[0] in "(-!~":
+            if word[0] == "(":
+                tokens.append(("(", "("))
+            elif len(word) == 1:
+                break
+            else:
+                tokens.append(("NOT", word[0]) if word[0] != "~"
+                              else ("~", "~"))
+            word = word[1:]
+        closing = 0
+        # only split off the parentheses that aren't part of the tag itself,
+        # like in "fluttershy_(mlp)"
+        while word.endswith(")") and word.count(")") > word.count("("):
+            word, closing = word[:-1], closing + 1
+        if word:
+            tokens.append(("TERM", word))
+        return tokens + [(")", ")")] * closing
+
+    def __tokenize(self, query: str) -> list[tuple[str, str]]:
+        tokens = []
+        for word in re.findall(r",|[^\s,]+", query):
+            keyword = self.KEYWORDS.get(word.lower())
+            if keyword:
+                tokens.append((keyword, word))
+            else:
+                tokens += self.__split_word(word)
+
+        if "," not in query:
+            return tokens
+        # with comma separated tags (Derpibooru style), spaces are part of
+        # the tag names
+        merged = []
+        for token in tokens:
+            if token[0] == "TERM" and merged and merged[-1][0] == "TERM":
+                merged[-1] = ("TERM", f"{merged[-1][1]}_{token[1]}")
+            else:
+                merged.append(token)
+        return merged
+
+    def __peek(self) -> str:
+        if self.__pos < len(self.__tokens):
+            return self.__tokens[self.__pos][0]
+        return None
+
+    def __next(self) -> tuple[str, str]:
+        token = self.__tokens[self.__pos]
+        self.__pos += 1
+        return token
+
+    def parse(self) -> tuple:
+        if not self.__tokens:
+            return None
+        node = self.__parse_or()
+        if self.__peek() is not None:
+            raise ValueError(
+                f"Unexpected \"{self.__tokens[self.__pos][1]}\" in query"
+            )
+        return node
+
+    def __parse_or(self) -> tuple:
+        nodes = [self.__parse_and()]
+        while self.__peek() == "OR":
+            self.__next()
+            nodes.append(self.__parse_and())
+        nodes = [x for x in nodes if x is not None]
+        if not nodes:
+            return None
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def __parse_and(self) -> tuple:
+        nodes, any_of = [], []
+        while self.__peek() not in ["OR", ")", None]:
+            if self.__peek() == "AND":
+                self.__next()
+                continue
+            if self.__peek() == "~":
+                self.__next()
+                any_of.append(self.__parse_unary())
+                continue
+            nodes.append(self.__parse_unary())
+        nodes = [x for x in nodes if x is not None]
+        any_of = [x for x in any_of if x is not None]
+        if any_of:
+            nodes.append(any_of[0] if len(any_of) == 1 else ("or", any_of))
+        if not nodes:
+            return None
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def __parse_unary(self) -> tuple:
+        kind = self.__peek()
+        if kind is None:
+            raise ValueError("Query ends with an operator")
+        kind, value = self.__next()
+        if kind == "NOT":
+            node = self.__parse_unary()
+            return ("not", node) if node is not None else None
+        if kind == "(":
+            node = self.__parse_or()
+            if self.__peek() != ")":
+                raise ValueError("Unbalanced parentheses in query")
+            self.__next()
+            return node
+        if kind == "TERM":
+            if value.lower().startswith(TagIndex.IGNORED_METATAGS):
+                logger.info(f"Ignoring \"{value}\" in local query")
+                return None
+            return ("term", value)
+        raise ValueError(f"Unexpected \"{value}\" in query")
@@ -0,0 +1,130 @@
+from lpp.log import get_logger
+from email.utils import parsedate_to_datetime
+from os import path, makedirs
+import json
+import random
+import time
+
+try:
+    import fcntl
+
+    def _lock_file(f: object) -> None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def _unlock_file(f: object) -> None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+except ImportError:
+    import msvcrt
+
+    def _lock_file(f: object) -> None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+    def _unlock_file(f: object) -> None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+logger = get_logger()
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 6
+
+
+def parse_retry_after(value: str) -> float:
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backoff_delay(attempt: int, retry_after: float = None,
+                      base: float = 1, cap: float = 60) -> float:
+    # exponential backoff with full jitter, but never sooner than the server
+    # asked us to come back
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    return max(delay, retry_after) if retry_after is not None else delay
+
+
+class HostRateLimiter:
+    # Request slots for a host are handed out through a small lock-protected
+    # file in the work dir, so every LPP instance on the machine (ComfyUI,
+    # A1111, fetch jobs...) shares one request budget per host.
+    SLOWDOWN_STEP = 2
+    SLOWDOWN_MAX = 32
+    RECOVERY_STEP = 0.9
+
+    def __init__(self, host: str, interval: float, work_dir: str = "."):
+        self.host = host
+        self.interval = interval
+        self._slowdown = 1
+        self._dir = path.join(work_dir, "rate_limits")
+        self._file = path.join(self._dir, f"{host}.json")
+
+    def _update_state(self, update: callable) -> object:
+        makedirs(self._dir, exist_ok=True)
+        with open(self._file, "a+", encoding="utf-8") as f:
+            _lock_file(f)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read())
+                except ValueError:
+                    state = {}
+                result = update(state)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                _unlock_file(f)
+        return result
+
+    def reserve(self) -> float:
+        # returns how long the caller has to wait before sending its request
+        def take_slot(state: dict[str:object]) -> float:
+            now = time.time()
+            slot = max(now, state.get("next_slot", 0))
+            self._slowdown = state.get("slowdown", 1)
+            state["next_slot"] = slot + self.interval * self._slowdown
+            return slot - now
+
+        return self.__try_update_state(take_slot, self.interval)
+
+    def back_off(self, delay: float, throttled: bool = True) -> None:
+        # postpones the next slot for everyone and, when the host is
+        # throttling us, makes the request interval longer
+        def postpone(state: dict[str:object]) -> None:
+            slowdown = state.get("slowdown", 1)
+            if throttled:
+                slowdown = min(slowdown * self.SLOWDOWN_STEP,
+                               self.SLOWDOWN_MAX)
+            state["slowdown"] = self._slowdown = slowdown
+            state["next_slot"] = max(state.get("next_slot", 0),
+                                     time.time() + delay)
+
+        self.__try_update_state(postpone)
+
+    def succeeded(self) -> None:
+        # gradually speeds back up to the nominal request interval
+        def recover(state: dict[str:object]) -> None:
+            slowdown = state.get("slowdown", 1)
+            state["slowdown"] = self._slowdown = \
+                max(slowdown * self.RECOVERY_STEP, 1)
+
+        if self._slowdown > 1:
+            self.__try_update_state(recover)
+
+    def __try_update_state(self, update: callable,
+                           fallback: object = None) -> object:
+        try:
+            return self._update_state(update)
+        except OSError as e:
+            # a broken state file must never block fetching altogether
+            logger.debug(f"Shared rate limiter unavailable for {self.host} ({e})")
+            return fallback
@@ -0,0 +1,47 @@
+import random
+
+
+class SeededPermutation:
+    # A pseudo-random permutation of range(size) that maps any single index
+    # in O(1), without ever materializing the shuffled order: a balanced
+    # Feistel network over the smallest even number of bits covering size,
+    # with cycle walking to skip the values past the end of the range.
+    ROUNDS = 6
+
+    def __init__(self, size: int, key: str):
+        if size <= 0:
+            raise ValueError("Can't permute an empty range")
+        self.size: int = size
+        self.__half: int = (max((size - 1).bit_length(), 2) + 1) // 2
+        self.__mask: int = (1 << self.__half) - 1
+        # str seeds are hashed with SHA-512, so the round keys are the same
+        # on every run and machine
+        rng = random.Random(key)
+        self.__keys: list[int] = [
+            rng.getrandbits(32) for _ in range(self.ROUNDS)
+        ]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __round(self, value: int, key: int) -> int:
+        # the 32 bit MurmurHash3 finalizer, so every output bit depends on
+        # every input bit even for tiny ranges
+        value ^= key
+        value = ((value ^ (value >> 16)) * 0x85EBCA6B) & 0xFFFFFFFF
+        value = ((value ^ (value >> 13)) * 0xC2B2AE35) & 0xFFFFFFFF
+        return (value ^ (value >> 16)) & self.__mask
+
+    def __getitem__(self, index: int) -> int:
+        if not 0 <= index < self.size:
+            raise IndexError("Permutation index out of range")
+        value = index
+        # the network permutes up to four times as many values as the range
+        # holds, so on average it's walked less than four times
+        while True:
+            left, right = value >> self.__half, value & self.__mask
+            for key in self.__keys:
+                left, right = right, left ^ self.__round(right, key)
+            value = (left << self.__half) | right
+            if value < self.size:
+                return value
@@ -1,23 +1,34 @@
 from lpp.sources.common import TagSourceBase, Tags
 from lpp.sources.utils import get_sources
 from lpp.data import TagData, Models, Ratings
+from lpp.index import TagIndex
+from lpp.stats import TagStats
+from lpp.dedup import NearDuplicateFinder
+from lpp.strata import TagStrata
+from lpp.permutation import SeededPermutation
 from random import sample
+import hashlib
+import json
+import random
 import re
 
 
 class Prompts:
-    def __init__(self, chosen_prompts: list[object], source: TagSourceBase):
+    def __init__(self,
+                 chosen_prompts: list[object],
+                 source: object):
         self.__prompts = chosen_prompts
-        self.__source = source
+        # mixed pools hand in the source of every single prompt
+        self.__sources = source if isinstance(source, list) \
+            else [source] * len(chosen_prompts)
         self.__processed_tags = []
         self.__processed_prompts = []
 
     def apply_formatting(self, model: str):
-        source = self.__source
-        format_func = source.formatters[model]\
-            if model in source.supported_models\
-            else source.default_formatter
-        for raw_tags in self.__prompts:
+        for raw_tags, source in zip(self.__prompts, self.__sources):
+            format_func = source.formatters[model]\
+                if model in source.supported_models\
+                else source.default_formatter
             self.__processed_tags.append(
                 Tags(format_func(raw_tags))
             )
@@ -82,20 +93,161 @@ class Prompts:
 
 
 class PromptPool:
-    def __init__(self, tag_data: TagData, work_dir: str = "."):
-        self.__source = get_sources(work_dir)[tag_data.source]
+    def __init__(self,
+                 tag_data: TagData,
+                 work_dir: str = ".",
+                 sources: dict[str:TagSourceBase] = None):
+        sources = sources or get_sources(work_dir)
+        self.__source = sources[tag_data.source]
         self.tag_data = tag_data
+        self.__index: TagIndex = None
+        self.__indexed_data: TagData = None
+        self.__stats: TagStats = None
+        self.__counted_data: TagData = None
+        self.__dedup: NearDuplicateFinder = None
+        self.__deduped_data: TagData = None
+        self.__strata: dict[str:TagStrata] = {}
+        self.__stratified_data: TagData = None
+        self.__hash: object = None
+        self.__hashed_data: TagData = None
+        self.__hashed_size: int = 0
+
+    @property
+    def version(self) -> str:
+        # a digest of the collection's contents, kept up to date one new
+        # prompt at a time since collections only grow at the end
+        if self.__hashed_data is not self.tag_data:
+            self.__hash = hashlib.sha1(
+                f"{self.tag_data.source}:{self.tag_data.query}".encode("utf-8")
+            )
+            self.__hashed_data = self.tag_data
+            self.__hashed_size = 0
+        for raw_tags in self.tag_data.raw_tags[self.__hashed_size:]:
+            self.__hash.update(
+                json.dumps(raw_tags, sort_keys=True).encode("utf-8") + b"\n"
+            )
+        self.__hashed_size = len(self.tag_data.raw_tags)
+        return self.__hash.hexdigest()[:12]
+
+    @staticmethod
+    def get_seeded_rng(version: str,
+                       seed: int,
+                       index: int = None) -> random.Random:
+        # str seeds are hashed with SHA-512, so draws are the same on every
+        # run and machine, unlike hash() of a tuple
+        key = f"{version}:{seed}" if index is None \
+            else f"{version}:{seed}:{index}"
+        return random.Random(key)
+
+    @property
+    def index(self) -> TagIndex:
+        # built on first use and then only extended with new prompts
+        if self.__indexed_data is not self.tag_data:
+            self.__index = TagIndex()
+            self.__indexed_data = self.tag_data
+        return self.__index.update(self.tag_data, self.__source)
+
+    @property
+    def stats(self) -> TagStats:
+        if self.__counted_data is not self.tag_data:
+            self.__stats = TagStats()
+            self.__counted_data = self.tag_data
+        return self.__stats.update(self.tag_data, self.__source)
+
+    def get_unique_items(self, threshold: float = 0.8) -> list[int]:
+        if self.__deduped_data is not self.tag_data \
+                or self.__dedup.threshold != threshold:
+            self.__dedup = NearDuplicateFinder(threshold)
+            self.__deduped_data = self.tag_data
+        return self.__dedup.update(self.tag_data, self.__source).unique_items
+
+    def get_strata(self, category: str) -> TagStrata:
+        if self.__stratified_data is not self.tag_data:
+            self.__strata = {}
+            self.__stratified_data = self.tag_data
+        if category not in self.__strata:
+            self.__strata[category] = TagStrata(category)
+        return self.__strata[category].update(self.tag_data, self.__source)
+
+    def select(self, query: str, count: int = None) -> TagData:
+        if not self.tag_data:
+            raise ValueError("No prompts are currently loaded.")
+        return self.index.select(self.tag_data, query, count)
+
+    @property
+    def source(self) -> TagSourceBase:
+        return self.__source
 
     def choose_prompts(self,
                        n: int = 1,
-                       allowed_ratings: list[str] = None
+                       allowed_ratings: list[str] = None,
+                       query: str = None,
+                       dedup_threshold: float = None,
+                       stratify_by: str = None,
+                       balance: str = "uniform",
+                       seed: int = None
                        ) -> Prompts:
+        return Prompts(
+            self.sample_raw_tags(n, allowed_ratings, query, dedup_threshold,
+                                 stratify_by, balance, seed),
+            self.__source
+        )
+
+    def sample_raw_tags(self,
+                        n: int = 1,
+                        allowed_ratings: list[str] = None,
+                        query: str = None,
+                        dedup_threshold: float = None,
+                        stratify_by: str = None,
+                        balance: str = "uniform",
+                        seed: int = None,
+                        positions: list[int] = None
+                        ) -> list[object]:
+        # with a seed, every prompt is a pure function of the collection
+        # version, the seed, its position in the batch and the selection
+        # options, so any image can be reproduced later from those alone.
+        # Unstratified positions index one seeded permutation of the
+        # prompts, so no prompt repeats before the collection runs out.
         if not self.tag_data:
             raise ValueError("No prompts are currently loaded.")
 
         raw_tags = self.tag_data.raw_tags
         source = self.__source
 
+        items = None
+        if query or dedup_threshold:
+            items = self.index.search(query) if query \
+                else range(len(raw_tags))
+            if dedup_threshold:
+                unique = set(self.get_unique_items(dedup_threshold))
+                items = [x for x in items if x in unique]
+            if len(items) == 0:
+                raise ValueError(
+                    "Current collection doesn't seem to have prompts matching the query."
+                )
+
+        if stratify_by:
+            if allowed_ratings and len(allowed_ratings) >= len(Ratings):
+                allowed_ratings = None
+            strata = self.get_strata(stratify_by)
+            items = set(items) if items is not None else None
+            if seed is None:
+                chosen = strata.sample(n, allowed_ratings, balance, items)
+            else:
+                chosen = strata.sample_at(
+                    positions if positions is not None else range(n),
+                    allowed_ratings, balance, items,
+                    f"{self.version}:{seed}"
+                )
+            if not chosen:
+                raise ValueError(
+                    "Current collection doesn't seem to have prompts with selected rating(s)."
+                )
+            return [raw_tags[x] for x in chosen]
+
+        if items is not None:
+            raw_tags = [raw_tags[x] for x in items]
+
         if allowed_ratings and len(allowed_ratings) < len(Ratings):
             raw_tags = [
                 x for x in raw_tags if (source.get_lpp_rating(x) in allowed_ratings)
@@ -105,13 +257,120 @@ class PromptPool:
                     "Current collection doesn't seem to have prompts with selected rating(s)."
                 )
 
+        if seed is not None:
+            order = SeededPermutation(len(raw_tags), f"{self.version}:{seed}")
+            return [
+                raw_tags[order[i % len(order)]]
+                for i in (positions if positions is not None else range(n))
+            ]
+
         # manually handle requests for more images than we have tags
         # because random.sample would raise a ValueError
         if n > len(raw_tags):
             factor = n // len(raw_tags) + 1  # +1 because // rounds down
             raw_tags = raw_tags * factor
-        return Prompts(sample(raw_tags, k=n), self.__source)
+        return sample(raw_tags, k=n)
 
     @property
     def prompts_count(self) -> int:
         return len(self.tag_data.raw_tags)
+
+
+class AliasTable:
+    # Vose's alias method: O(n) to build, then every draw is one uniform
+    # pick plus one biased coin flip, no matter how many weights there are
+    def __init__(self, weights: list[float]):
+        total = sum(weights)
+        if total <= 0 or any(x < 0 for x in weights):
+            raise ValueError("Weights must be non-negative with a positive sum")
+        n = len(weights)
+        scaled = [x * n / total for x in weights]
+        self.__prob = [1.0] * n
+        self.__alias = list(range(n))
+        small = [i for i, x in enumerate(scaled) if x < 1]
+        large = [i for i, x in enumerate(scaled) if x >= 1]
+        while small and large:
+            s, g = small.pop(), large.pop()
+            self.__prob[s], self.__alias[s] = scaled[s], g
+            scaled[g] -= 1 - scaled[s]
+            (small if scaled[g] < 1 else large).append(g)
+
+    def sample(self, rng: object = random) -> int:
+        i = rng.randrange(len(self.__prob))
+        return i if rng.random() < self.__prob[i] else self.__alias[i]
+
+
+class MixedPromptPool:
+    def __init__(self,
+                 weighted_tag_data: list[tuple[object, float]],
+                 work_dir: str = "."):
+        weighted_tag_data = [x for x in weighted_tag_data if x[1] > 0]
+        if not weighted_tag_data:
+            raise ValueError("Nothing to mix, all weights are zero.")
+        # already built pools can be mixed as they are
+        self.__pools = [
+            x if isinstance(x, PromptPool) else PromptPool(x, work_dir)
+            for x, _ in weighted_tag_data
+        ]
+        self.__weights = [float(x) for _, x in weighted_tag_data]
+        self.__alias_table = AliasTable(self.__weights)
+
+    @property
+    def version(self) -> str:
+        digest = hashlib.sha1(json.dumps(
+            [[x.version, w] for x, w in zip(self.__pools, self.__weights)]
+        ).encode("utf-8"))
+        return digest.hexdigest()[:12]
+
+    @property
+    def pools(self) -> list[PromptPool]:
+        return list(self.__pools)
+
+    @property
+    def weights(self) -> list[float]:
+        return list(self.__weights)
+
+    @property
+    def prompts_count(self) -> int:
+        return sum(x.prompts_count for x in self.__pools)
+
+    def choose_prompts(self,
+                       n: int = 1,
+                       allowed_ratings: list[str] = None,
+                       stratify_by: str = None,
+                       balance: str = "uniform",
+                       seed: int = None,
+                       dedup_threshold: float = None) -> Prompts:
+        # collections without prompts of the allowed ratings drop out up
+        # front, so which collection a position draws from never depends on
+        # the rest of the batch
+        usable = [
+            i for i, x in enumerate(self.__pools)
+            if not allowed_ratings
+            or any(x.stats.ratings.get(r) for r in allowed_ratings)
+        ]
+        if not usable:
+            raise ValueError(
+                "None of the mixed collections seem to have prompts with selected rating(s)."
+            )
+        table = self.__alias_table if len(usable) == len(self.__pools) \
+            else AliasTable([self.__weights[i] for i in usable])
+        version = self.version if seed is not None else None
+        slots = {}
+        for position in range(n):
+            rng = PromptPool.get_seeded_rng(version, seed, position) \
+                if seed is not None else random
+            slots.setdefault(usable[table.sample(rng)], []).append(position)
+
+        chosen, sources = [None] * n, [None] * n
+        for i, positions in slots.items():
+            raw_tags = self.__pools[i].sample_raw_tags(
+                len(positions), allowed_ratings,
+                dedup_threshold=dedup_threshold,
+                stratify_by=stratify_by, balance=balance,
+                seed=seed, positions=positions
+            )
+            for position, item in zip(positions, raw_tags):
+                chosen[position] = item
+                sources[position] = self.__pools[i].source
+        return Prompts(chosen, sources)
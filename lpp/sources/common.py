@@ -1,10 +1,21 @@
 from lpp.log import get_logger
 from abc import ABC, abstractmethod
-from lpp.data import TagData, TagGroups, FilterData
-from dataclasses import asdict
-import requests
+from lpp.data import TagData, TagGroups, FilterData, FetchCheckpoint
+from lpp.net import HostRateLimiter, RETRY_STATUSES, MAX_RETRIES, parse_retry_after, get_backoff_delay
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Coroutine
+from urllib.parse import urlparse
+import asyncio
 import os
+import hashlib
+import inspect
 import json
+import re
+import threading
+import time
+
+USER_AGENT = "lazy-pony-prompter (by user Siberpone)/v1.1.x"
 
 
 def formatter(model_name: str) -> callable:
@@ -31,18 +42,128 @@ def attach_query_param(name: str, display_name: str) -> callable:
     return inner
 
 
+def run_sync(coro: object) -> object:
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if loop is None:
+        return asyncio.run(coro)
+    # called from inside a running event loop, so the coroutine gets its own
+    # loop in a worker thread instead of blocking (or nesting into) this one
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+class FetchInterruptedError(Exception):
+    def __init__(self, tag_data: TagData, cause: Exception):
+        super().__init__(
+            f"{cause} ({type(cause).__name__}). "
+            f"{len(tag_data.raw_tags)} prompts were fetched before the "
+            "failure; send the same query again to resume."
+        )
+        self.tag_data = tag_data
+
+
+class FetchCancelledError(FetchInterruptedError):
+    def __init__(self, tag_data: TagData):
+        Exception.__init__(
+            self,
+            f"Fetch cancelled after {len(tag_data.raw_tags)} prompts; send "
+            "the same query again to resume."
+        )
+        self.tag_data = tag_data
+
+
+class CancellationToken:
+    def __init__(self):
+        self.__event = threading.Event()
+
+    def cancel(self) -> None:
+        self.__event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.__event.is_set()
+
+
+@dataclass
+class FetchProgress:
+    pages_done: int = 0
+    posts_done: int = 0
+    posts_total: int = 0
+    bytes_done: int = 0
+    elapsed: float = 0
+    rate_limit_wait: float = 0
+
+    @property
+    def posts_per_second(self) -> float:
+        return self.posts_done / self.elapsed if self.elapsed > 0 else 0
+
+    @property
+    def eta(self) -> float:
+        rate = self.posts_per_second
+        if rate == 0:
+            return None
+        return max(self.posts_total - self.posts_done, 0) / rate
+
+    def __str__(self) -> str:
+        eta = f"{self.eta:.0f}s" if self.eta is not None else "?"
+        wait = f", waiting {self.rate_limit_wait:.1f}s for rate limit" \
+            if self.rate_limit_wait > 0 else ""
+        return (
+            f"{self.posts_done}/{self.posts_total} posts, "
+            f"{self.pages_done} pages, {self.bytes_done / 1048576:.1f} MiB, "
+            f"{self.posts_per_second:.1f} posts/s, ETA {eta}{wait}"
+        )
+
+
+class ConsoleProgress:
+    def __init__(self):
+        self.__bar = None
+
+    def __call__(self, progress: FetchProgress) -> None:
+        if not self.__bar:
+            from tqdm import tqdm
+            self.__bar = tqdm(total=progress.posts_total,
+                              desc="[LPP] Fetching tags", unit="posts")
+        self.__bar.update(progress.posts_done - self.__bar.n)
+        self.__bar.set_postfix_str(
+            f"{progress.pages_done} pages, "
+            f"{progress.bytes_done / 1048576:.1f} MiB"
+        )
+
+    def close(self) -> None:
+        if self.__bar:
+            self.__bar.close()
+
+
 class TagSourceBase(ABC):
+    ENDPOINT = ""
+    PER_PAGE_MAX = 1
+    QUERY_DELAY = 0
+    CURSOR_AFTER_PAGE = None
+    QUERY_PARAM = "tags"
+    IDS_PER_REQUEST = 100
+    DUMP_FIELDS = ()
+
     def __init__(self,
                  syntax_help_url: str = "",
                  query_hint: str = "",
                  work_dir: str = "."):
         self._work_dir: str = work_dir
         self._logger = get_logger()
+        self._rate_limiter = HostRateLimiter(
+            urlparse(self.ENDPOINT).netloc, self.QUERY_DELAY, work_dir
+        )
         self.syntax_help_url = syntax_help_url
         self.query_hint = query_hint
         self.formatters: dict[str:callable] = {}
         self.default_formatter: callable = None
         self.extra_query_params: dict[str:callable] = {}
+        # bumped whenever the choices of extra_query_params change, so UIs
+        # know when to refresh them
+        self.query_params_revision: int = 0
         for attr in [x for x in dir(self) if not x.startswith("_")]:
             obj = getattr(self, attr)
             if hasattr(obj, "is_formatter"):
@@ -54,17 +175,309 @@ class TagSourceBase(ABC):
 
     def _send_api_request(
         self, endpoint: str, query_params: dict[str:str],
-        user_agent: str = "lazy-pony-prompter (by user Siberpone)/v1.1.x"
+        user_agent: str = USER_AGENT
     ) -> dict[str:object]:
+        import requests
         TIMEOUTS = (9.1, 15.1)
-        req = requests.get(
-            endpoint,
-            query_params,
-            timeout=TIMEOUTS,
-            headers={"User-Agent": user_agent}
+        for attempt in range(MAX_RETRIES + 1):
+            time.sleep(self._rate_limiter.reserve())
+            try:
+                req = requests.get(
+                    endpoint,
+                    query_params,
+                    timeout=TIMEOUTS,
+                    headers={"User-Agent": user_agent}
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == MAX_RETRIES:
+                    raise
+                self.__back_off(attempt, None, False)
+                continue
+            if req.status_code in RETRY_STATUSES and attempt < MAX_RETRIES:
+                self.__back_off(attempt, req.headers.get("Retry-After"))
+                continue
+            req.raise_for_status()
+            self._rate_limiter.succeeded()
+            return req.json()
+
+    async def _asend_api_request(
+        self, session: "aiohttp.ClientSession",
+        endpoint: str, query_params: dict[str:object],
+        on_wait: callable = None
+    ) -> tuple[object, int]:
+        import aiohttp
+        # the rate limiter locks and rewrites a file shared between
+        # processes, which must not stall the event loop
+        for attempt in range(MAX_RETRIES + 1):
+            wait = await asyncio.to_thread(self._rate_limiter.reserve)
+            if on_wait:
+                on_wait(wait)
+            await asyncio.sleep(wait)
+            try:
+                async with session.get(
+                    endpoint,
+                    params={k: str(v) for k, v in query_params.items()}
+                ) as response:
+                    if response.status in RETRY_STATUSES \
+                            and attempt < MAX_RETRIES:
+                        await asyncio.to_thread(
+                            self.__back_off,
+                            attempt, response.headers.get("Retry-After")
+                        )
+                        continue
+                    response.raise_for_status()
+                    body = await response.read()
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                    asyncio.TimeoutError):
+                if attempt == MAX_RETRIES:
+                    raise
+                await asyncio.to_thread(
+                    self.__back_off, attempt, None, False
+                )
+                continue
+            await asyncio.to_thread(self._rate_limiter.succeeded)
+            return json.loads(body), len(body)
+
+    def __back_off(self, attempt: int, retry_after: str,
+                   throttled: bool = True) -> None:
+        delay = get_backoff_delay(attempt, parse_retry_after(retry_after))
+        self._logger.info(
+            f"{'Throttled' if throttled else 'Connection failed'}, retrying "
+            f"in {delay:.1f}s (attempt {attempt + 1}/{MAX_RETRIES})"
+        )
+        self._rate_limiter.back_off(delay, throttled)
+
+    def request_tags(self, query: str, count: int, *params: object,
+                     progress: callable = None,
+                     cancel_token: CancellationToken = None,
+                     on_page: callable = None,
+                     **kwparams: object) -> TagData:
+        return run_sync(self.arequest_tags(
+            query, count, *params, progress=progress,
+            cancel_token=cancel_token, on_page=on_page, **kwparams
+        ))
+
+    async def arequest_tags(self, query: str, count: int, *params: object,
+                            progress: callable = None,
+                            cancel_token: CancellationToken = None,
+                            on_page: callable = None,
+                            **kwparams: object) -> TagData:
+        args = inspect.signature(self._prepare_query).bind(
+            query, count, *params, **kwparams
+        )
+        tag_data, query_params = self._prepare_query(*args.args, **args.kwargs)
+        if "random_seed" in tag_data.other_params \
+                and args.arguments.get("seed") is None:
+            # an unseeded random fetch continues the random order of its
+            # partial fetch instead of drawing a new one
+            seed = await asyncio.to_thread(
+                FetchCheckpoint(tag_data, query_params, self._work_dir)
+                .get_random_seed
+            )
+            if seed is not None:
+                args.arguments["seed"] = seed
+                tag_data, query_params = self._prepare_query(
+                    *args.args, **args.kwargs
+                )
+        return await self._fetch_pages(
+            tag_data, query_params, count, progress, cancel_token, on_page
+        )
+
+    def request_tags_by_ids(self, post_ids: list[int], *params: object,
+                            progress: callable = None,
+                            cancel_token: CancellationToken = None,
+                            **kwparams: object) -> TagData:
+        return run_sync(self.arequest_tags_by_ids(
+            post_ids, *params, progress=progress,
+            cancel_token=cancel_token, **kwparams
+        ))
+
+    async def arequest_tags_by_ids(self, post_ids: list[int], *params: object,
+                                   progress: callable = None,
+                                   cancel_token: CancellationToken = None,
+                                   **kwparams: object) -> TagData:
+        post_ids = list(dict.fromkeys(int(x) for x in post_ids))
+        if not post_ids:
+            raise ValueError("No post ids to fetch")
+        id_chunks = [
+            post_ids[i:i + self.IDS_PER_REQUEST]
+            for i in range(0, len(post_ids), self.IDS_PER_REQUEST)
+        ]
+        tag_data, query_params = self._prepare_query(
+            "", len(post_ids), *params, **kwparams
+        )
+        digest = hashlib.sha1(
+            ",".join(str(x) for x in post_ids).encode("utf-8")
+        ).hexdigest()[:8]
+        tag_data.query = f"{len(post_ids)} post ids ({digest})"
+        return await self._fetch_pages(
+            tag_data, query_params, len(post_ids), progress, cancel_token,
+            id_chunks=id_chunks
+        )
+
+    async def _cancellable(self,
+                           awaitable: Coroutine,
+                           cancel_token: CancellationToken) -> object:
+        if not cancel_token:
+            return await awaitable
+        if cancel_token.cancelled:
+            awaitable.close()
+            raise asyncio.CancelledError()
+        task = asyncio.ensure_future(awaitable)
+        # the token may be set from another thread, so it has to be polled
+        while not task.done():
+            await asyncio.wait([task], timeout=0.1)
+            if cancel_token.cancelled and not task.done():
+                task.cancel()
+                raise asyncio.CancelledError()
+        return task.result()
+
+    async def _fetch_pages(self,
+                           tag_data: TagData,
+                           query_params: dict[str:object],
+                           count: int,
+                           progress: callable = None,
+                           cancel_token: CancellationToken = None,
+                           on_page: callable = None,
+                           id_chunks: list[list[int]] = None) -> TagData:
+        import aiohttp
+        # with id_chunks, every "page" is one request for a chunk of post ids
+        checkpoint = FetchCheckpoint(tag_data, query_params, self._work_dir)
+        # checkpoints are (un)pickled from files, which must not stall the
+        # other fetches sharing the event loop
+        raw_tags, post_ids, page = await asyncio.to_thread(
+            checkpoint.load, 0 if id_chunks else 1
+        )
+        base_query = query_params[self.QUERY_PARAM]
+        seen_ids = set(post_ids)
+        # tag_data shares the growing lists, so whoever receives it through
+        # on_page sees every new page without any copying
+        tag_data.raw_tags = raw_tags
+        tag_data.post_ids = post_ids
+        if raw_tags:
+            self._logger.info(
+                f"Resuming partial fetch with {len(raw_tags)} prompts"
+            )
+            if on_page:
+                on_page(tag_data)
+
+        console_progress = None
+        if not progress:
+            progress = console_progress = ConsoleProgress()
+        state = FetchProgress(posts_done=min(len(raw_tags), count),
+                              posts_total=count)
+        start = time.monotonic()
+
+        def report(rate_limit_wait: float = 0) -> None:
+            state.elapsed = time.monotonic() - start
+            state.rate_limit_wait = rate_limit_wait
+            progress(state)
+
+        timeout = aiohttp.ClientTimeout(sock_connect=9.1, sock_read=15.1)
+        try:
+            async with aiohttp.ClientSession(
+                timeout=timeout, headers={"User-Agent": USER_AGENT}
+            ) as session:
+                while page is not None and len(raw_tags) < count:
+                    if id_chunks:
+                        query_params[self.QUERY_PARAM] = \
+                            self._format_id_query(id_chunks[page], base_query)
+                        query_params["page"] = 1
+                    else:
+                        query_params["page"] = page
+                    json_response, size = await self._cancellable(
+                        self._asend_api_request(
+                            session, self.ENDPOINT, query_params, report
+                        ),
+                        cancel_token
+                    )
+                    posts = self._get_posts(json_response)
+                    page_tags, page_ids = [], []
+                    for post in posts:
+                        if post["id"] in seen_ids:
+                            continue
+                        seen_ids.add(post["id"])
+                        page_ids.append(post["id"])
+                        page_tags.append(self._extract_raw_tags(post))
+                    if id_chunks:
+                        page = page + 1 if page + 1 < len(id_chunks) \
+                            else None
+                    elif posts and not page_tags:
+                        # random orders keep serving full pages of posts we
+                        # already have once the result set is exhausted
+                        page = None
+                    else:
+                        page = self._get_next_page(page, posts, query_params)
+                    await asyncio.to_thread(
+                        checkpoint.save_page, page, page_tags, page_ids
+                    )
+                    post_ids += page_ids
+                    raw_tags += page_tags
+                    if on_page and page_tags:
+                        on_page(tag_data)
+
+                    state.pages_done += 1
+                    state.posts_done = min(len(raw_tags), count)
+                    state.bytes_done += size
+                    report()
+        except asyncio.CancelledError:
+            tag_data.raw_tags = raw_tags[:count]
+            tag_data.post_ids = post_ids[:count]
+            raise FetchCancelledError(tag_data)
+        except Exception as e:
+            tag_data.raw_tags = raw_tags[:count]
+            tag_data.post_ids = post_ids[:count]
+            raise FetchInterruptedError(tag_data, e) from e
+        finally:
+            if console_progress:
+                console_progress.close()
+
+        await asyncio.to_thread(checkpoint.delete)
+        tag_data.raw_tags = raw_tags[:count]
+        tag_data.post_ids = post_ids[:count]
+        return tag_data
+
+    def _get_next_page(self,
+                       page: object,
+                       posts: list[dict[str:object]],
+                       query_params: dict[str:object]) -> object:
+        if len(posts) < self.PER_PAGE_MAX:
+            return None
+        # deep offset pages get slow and are capped by the boorus, so after
+        # a few pages switch to "posts below id" cursor where possible
+        if self.CURSOR_AFTER_PAGE and self._can_use_cursor(query_params) \
+                and (isinstance(page, str) or page >= self.CURSOR_AFTER_PAGE):
+            return f"b{min(x['id'] for x in posts)}"
+        return page + 1
+
+    def _can_use_cursor(self, query_params: dict[str:object]) -> bool:
+        # id cursors only make sense for the default newest first order
+        return not re.search(r"(^|\s)order:(?!id_desc(\s|$))",
+                             query_params[self.QUERY_PARAM])
+
+    def _format_id_query(self, post_ids: list[int], base_query: str) -> str:
+        return " ".join(
+            x for x in ["id:" + ",".join(str(x) for x in post_ids), base_query]
+            if x
+        )
+
+    def get_index_terms(self, raw_tags: object) -> list[str]:
+        terms = []
+        tag_groups = self._convert_raw_tags(raw_tags)
+        for category in TagGroups.get_categories():
+            tags = getattr(tag_groups, category)
+            if isinstance(tags, str):
+                terms.append(f"{category}:{tags}")
+            else:
+                terms += tags
+        return terms
+
+    def _parse_dump_row(self,
+                        row: dict[str:str],
+                        tag_categories: dict[str:int]) -> dict[str:object]:
+        raise NotImplementedError(
+            f"{self.__class__.__name__} database dumps are not supported"
         )
-        req.raise_for_status()
-        return req.json()
 
     def _get_config(self) -> dict[str:object]:
         name = self.__class__.__name__.lower()
@@ -82,7 +495,16 @@ class TagSourceBase(ABC):
         pass
 
     @abstractmethod
-    def request_tags(self, query: str, count: int, *params: object) -> TagData:
+    def _prepare_query(self, query: str, count: int,
+                       *params: object) -> tuple[TagData, dict[str:object]]:
+        pass
+
+    @abstractmethod
+    def _get_posts(self, json_response: object) -> list[dict[str:object]]:
+        pass
+
+    @abstractmethod
+    def _extract_raw_tags(self, post: dict[str:object]) -> object:
         pass
 
     @abstractmethod
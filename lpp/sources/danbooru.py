@@ -1,11 +1,20 @@
 from lpp.sources.common import TagSourceBase, Tags, formatter, default_formatter, attach_query_param
 from lpp.data import TagData, TagGroups, Models, FilterData
-from tqdm import trange
 import re
-import time
 
 
 class Danbooru(TagSourceBase):
+    ENDPOINT = "https://danbooru.donmai.us/posts.json"
+    PER_PAGE_MAX = 200
+    QUERY_DELAY = 0.1
+    CURSOR_AFTER_PAGE = 5
+    POST_FIELDS = ("id", "rating", "tag_string_general", "tag_string_artist",
+                   "tag_string_character", "tag_string_copyright",
+                   "tag_string_meta")
+    DUMP_FIELDS = POST_FIELDS + ("tag_string", "is_deleted")
+    DUMP_TAG_CATEGORIES = {0: "general", 1: "artist", 3: "copyright",
+                           4: "character", 5: "meta"}
+
     def __init__(self, work_dir: str = "."):
         TagSourceBase.__init__(self,
                                "https://danbooru.donmai.us/wiki_pages/help%3Acheatsheet",
@@ -29,14 +38,10 @@ class Danbooru(TagSourceBase):
     def get_lpp_rating(self, raw_tags: dict[str:list[str]]) -> str:
         return self.__ratings["lpp"][raw_tags["rating"]]
 
-    def request_tags(
+    def _prepare_query(
         self, query: str, count: int,
-        rating: str = None, sort_type: str = None
-    ) -> TagData:
-        ENDPOINT = "https://danbooru.donmai.us/posts.json"
-        PER_PAGE_MAX = 200
-        QUERY_DELAY = 0.1
-
+        rating: str = None, sort_type: str = None, seed: int = None
+    ) -> tuple[TagData, dict[str:object]]:
         image_id = re.search(
             r"/^(?:https?:\/\/)?(?:danbooru\.donmai\.us\/posts\/)?(\d+)(\?.*)?$", query
         )
@@ -47,42 +52,55 @@ class Danbooru(TagSourceBase):
             and rating in self.__ratings["lookup"] else None
         p_sort = self.__sort_params[sort_type] if sort_type \
             and sort_type in self.__sort_params else None
+        if sort_type == "Random" and seed is not None:
+            self._logger.warning(
+                "Danbooru doesn't support seeded random order, the sample "
+                "won't be reproducible"
+            )
         p_query = " ".join(x for x in [query, p_rating, p_sort] if x)
         query_params = {
             "tags": p_query,
-            "limit": count if count < PER_PAGE_MAX else PER_PAGE_MAX
+            "limit": count if count < self.PER_PAGE_MAX else self.PER_PAGE_MAX,
+            "only": ",".join(self.POST_FIELDS)
         }
 
-        posts = []
-        pages_to_load = (count // PER_PAGE_MAX) + \
-            (1 if count % PER_PAGE_MAX > 0 else 0)
-
-        for p in trange(1, pages_to_load + 1, desc="[LPP] Fetching tags"):
-            time.sleep(QUERY_DELAY)
-            query_params["page"] = p
-            json_response = self._send_api_request(ENDPOINT, query_params)
-            posts += json_response
-            if len(json_response) < PER_PAGE_MAX:
-                break
-
-        processed_response = []
-        for post in posts:
-            post_tags = {
-                "general": post["tag_string_general"].split(" "),
-                "artist": post["tag_string_artist"].split(" "),
-                "rating": post["rating"],
-                "character": post["tag_string_character"].split(" "),
-                "meta": post["tag_string_meta"].split(" ")
-                + post["tag_string_copyright"].split(" ")
-            }
-            processed_response.append(post_tags)
-        return TagData(
-            self.__class__.__name__,
-            p_query,
-            processed_response[:count],
-            {}
+        return (
+            TagData(self.__class__.__name__, p_query, [], {}),
+            query_params
         )
 
+    def _get_posts(self, json_response: list[dict[str:object]]) -> list[dict[str:object]]:
+        return json_response
+
+    def _extract_raw_tags(self, post: dict[str:object]) -> dict[str:object]:
+        return {
+            "general": post["tag_string_general"].split(),
+            "artist": post["tag_string_artist"].split(),
+            "rating": post["rating"],
+            "character": post["tag_string_character"].split(),
+            "meta": post["tag_string_meta"].split()
+            + post["tag_string_copyright"].split()
+        }
+
+    def _parse_dump_row(self,
+                        row: dict[str:str],
+                        tag_categories: dict[str:int]) -> dict[str:object]:
+        if row.get("is_deleted") in ("t", "true", True):
+            return None
+        post = {"id": int(row["id"]), "rating": row["rating"]}
+        if row.get("tag_string_general") is not None:
+            # the full exports already split tags by category
+            post.update({k: row.get(k) or "" for k in self.POST_FIELDS[2:]})
+            return post
+        tags = {k: [] for k in self.POST_FIELDS[2:]}
+        for tag in row["tag_string"].split():
+            category = self.DUMP_TAG_CATEGORIES.get(
+                tag_categories.get(tag, 0), "general"
+            )
+            tags[f"tag_string_{category}"].append(tag)
+        post.update({k: " ".join(v) for k, v in tags.items()})
+        return post
+
     def _convert_raw_tags(self, raw_tags: dict[str:object]) -> TagGroups:
         return TagGroups(species=[], **raw_tags)
 
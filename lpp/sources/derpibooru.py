@@ -1,12 +1,23 @@
 from lpp.sources.common import TagSourceBase, Tags, formatter, default_formatter, attach_query_param
 from lpp.data import TagData, TagGroups, Models, FilterData
-from requests.exceptions import HTTPError, Timeout, ConnectionError, TooManyRedirects
-from tqdm import trange
-import time
+from os import path, makedirs
+import hashlib
+import json
+import random
 import re
+import threading
+import time
 
 
 class Derpibooru(TagSourceBase):
+    ENDPOINT = "https://derpibooru.org/api/v1/json/search/images"
+    PER_PAGE_MAX = 50
+    QUERY_DELAY = 0.5
+    QUERY_PARAM = "q"
+    IDS_PER_REQUEST = 50
+    USER_FILTERS_ENDPOINT = "https://derpibooru.org/api/v1/json/filters/user"
+    USER_FILTERS_TTL = 24 * 60 * 60
+
     def __init__(self, work_dir: str = "."):
         TagSourceBase.__init__(self,
                                "https://derpibooru.org/pages/search_syntax",
@@ -42,15 +53,13 @@ class Derpibooru(TagSourceBase):
                 return self.__ratings["lpp"][tag]
         return "Unknown"
 
-    def request_tags(self,
-                     query: str,
-                     count: int,
-                     filter_type: str = None,
-                     sort_type: str = None) -> TagData:
-        ENDPOINT = "https://derpibooru.org/api/v1/json/search/images"
-        PER_PAGE_MAX = 50
-        QUERY_DELAY = 0.5
+    def get_index_terms(self, raw_tags: list[str]) -> list[str]:
+        return list(raw_tags)
 
+    def _prepare_query(
+        self, query: str, count: int,
+        filter_type: str = None, sort_type: str = None, seed: int = None
+    ) -> tuple[TagData, dict[str:object]]:
         image_id = re.search(
             r"^(?:https?:\/\/)?(?:derpibooru\.org\/images\/)?(\d+)(\?.*)?$", query
         )
@@ -59,7 +68,7 @@ class Derpibooru(TagSourceBase):
 
         query_params = {
             "q": query,
-            "per_page": PER_PAGE_MAX
+            "per_page": self.PER_PAGE_MAX
         }
         if self.__api_key is not None:
             query_params["key"] = self.__api_key
@@ -67,30 +76,30 @@ class Derpibooru(TagSourceBase):
             query_params["filter_id"] = self.__filter_ids[filter_type]
         if sort_type is not None and sort_type in self.__sort_params.keys():
             query_params["sf"] = self.__sort_params[sort_type]
-
-        json_response = self._send_api_request(ENDPOINT, query_params)
-        response_total = json_response["total"]
-        items_total = count if count < response_total else response_total
-        pages_to_load = (items_total // PER_PAGE_MAX) + \
-            (1 if items_total % PER_PAGE_MAX > 0 else 0)
-
-        raw_tags = []
-        for p in trange(1, pages_to_load + 1, desc="[LPP] Fetching tags"):
-            time.sleep(QUERY_DELAY)
-            query_params["page"] = p
-            json_response = self._send_api_request(ENDPOINT, query_params)
-            raw_tags += [x["tags"] for x in json_response["images"]]
-
-        return TagData(
-            self.__class__.__name__,
-            query,
-            raw_tags[:items_total],
-            {
-                "filter_type": filter_type,
-                "sort_type": sort_type,
-            }
+        other_params = {
+            "filter_type": filter_type,
+            "sort_type": sort_type,
+        }
+        if sort_type == "Random":
+            seed = seed if seed is not None else random.randint(0, 2**31 - 1)
+            query_params["sf"] = f"random:{seed}"
+            other_params["random_seed"] = seed
+
+        return (
+            TagData(self.__class__.__name__, query, [], other_params),
+            query_params
         )
 
+    def _get_posts(self, json_response: dict[str:object]) -> list[dict[str:object]]:
+        return json_response["images"]
+
+    def _format_id_query(self, post_ids: list[int], base_query: str) -> str:
+        id_query = " || ".join(f"id:{x}" for x in post_ids)
+        return f"({id_query}), ({base_query})" if base_query else id_query
+
+    def _extract_raw_tags(self, post: dict[str:object]) -> list[str]:
+        return post["tags"]
+
     def _convert_raw_tags(self, raw_tags: list[str]) -> TagGroups:
         sorted_tags = {k: [] for k in TagGroups.get_categories()}
         for tag in raw_tags:
@@ -117,18 +126,67 @@ class Derpibooru(TagSourceBase):
         if not key:
             return
         self.__api_key = key
-        self.__fetch_user_filters()
+        # cached user filters are available right away, and the network is
+        # only hit in the background once they're missing or stale
+        cached_filters, fetched_at = self.__load_user_filters()
+        if cached_filters:
+            self.__add_user_filters(cached_filters)
+        if time.time() - fetched_at > self.USER_FILTERS_TTL:
+            threading.Thread(
+                target=self.__fetch_user_filters,
+                name="lpp-derpibooru-filters",
+                daemon=True
+            ).start()
+
+    @property
+    def __user_filters_file(self) -> str:
+        return path.join(self._work_dir, "user_filters", "derpibooru.json")
+
+    @property
+    def __api_key_hash(self) -> str:
+        # the key itself never ends up on disk
+        return hashlib.sha256(self.__api_key.encode("utf-8")).hexdigest()
+
+    def __load_user_filters(self) -> tuple[dict[str:int], float]:
+        try:
+            with open(self.__user_filters_file, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+            if cache["key"] == self.__api_key_hash:
+                return cache["filters"], cache["fetched_at"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return {}, 0
+
+    def __save_user_filters(self, filters: dict[str:int]) -> None:
+        try:
+            makedirs(path.dirname(self.__user_filters_file), exist_ok=True)
+            with open(self.__user_filters_file, "w", encoding="utf-8") as f:
+                json.dump({
+                    "key": self.__api_key_hash,
+                    "fetched_at": time.time(),
+                    "filters": filters
+                }, f)
+        except OSError as e:
+            self._logger.debug(f"Failed to cache Derpibooru user filters ({e})")
+
+    def __add_user_filters(self, filters: dict[str:int]) -> None:
+        # swapped in whole, so a UI reading the filters from another thread
+        # never sees a half updated dict
+        self.__filter_ids = {**self.__filter_ids, **filters}
+        self.query_params_revision += 1
 
     def __fetch_user_filters(self) -> None:
+        from requests.exceptions import HTTPError, Timeout, ConnectionError, TooManyRedirects
         self._logger.info("Attempting to fetch Derpibooru user filters...")
         try:
             json_response = self._send_api_request(
-                "https://derpibooru.org/api/v1/json/filters/user",
+                self.USER_FILTERS_ENDPOINT,
                 {"key": self.__api_key}
             )
 
-            for filter in json_response["filters"]:
-                self.__filter_ids[filter["name"]] = filter["id"]
+            filters = {x["name"]: x["id"] for x in json_response["filters"]}
+            self.__add_user_filters(filters)
+            self.__save_user_filters(filters)
             self._logger.info("Successfully fetched Derpibooru user filters.")
         except (HTTPError, ConnectionError, TooManyRedirects):
             self._logger.warning(
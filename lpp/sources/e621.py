@@ -1,11 +1,23 @@
 from lpp.sources.common import TagSourceBase, Tags, formatter, default_formatter, attach_query_param
 from lpp.data import TagData, TagGroups, Models, FilterData
-from tqdm import trange
+import random
 import re
-import time
 
 
 class E621(TagSourceBase):
+    ENDPOINT = "https://e621.net/posts.json"
+    PER_PAGE_MAX = 320
+    QUERY_DELAY = 1
+    CURSOR_AFTER_PAGE = 5
+    TAG_CATEGORIES = ("character", "species", "artist", "general",
+                      "copyright", "meta")
+    DUMP_FIELDS = ("id", "rating", "tag_string", "is_deleted")
+    # categories missing from TAG_CATEGORIES, like contributor, are dropped
+    # by _extract_raw_tags just as they are for API responses
+    DUMP_TAG_CATEGORIES = {0: "general", 1: "artist", 2: "contributor",
+                           3: "copyright", 4: "character", 5: "species",
+                           6: "invalid", 7: "meta", 8: "lore"}
+
     def __init__(self, work_dir: str = "."):
         TagSourceBase.__init__(self,
                                "https://e621.net/help/cheatsheet",
@@ -29,14 +41,10 @@ class E621(TagSourceBase):
     def get_lpp_rating(self, raw_tags: dict[str:list[str]]) -> str:
         return self.__ratings["lpp"][raw_tags["rating"]]
 
-    def request_tags(
+    def _prepare_query(
         self, query: str, count: int,
-        rating: str = None, sort_type: str = None
-    ) -> TagData:
-        ENDPOINT = "https://e621.net/posts.json"
-        PER_PAGE_MAX = 320
-        QUERY_DELAY = 1
-
+        rating: str = None, sort_type: str = None, seed: int = None
+    ) -> tuple[TagData, dict[str:object]]:
         image_id = re.search(
             r"^(?:https?:\/\/)?(?:e621\.net\/posts\/)?(\d+)(\?.*)?$", query
         )
@@ -47,43 +55,56 @@ class E621(TagSourceBase):
             and rating in self.__ratings["lookup"] else None
         p_sort = self.__sort_params[sort_type] if sort_type \
             and sort_type in self.__sort_params else None
+        other_params = {}
+        if sort_type == "Random":
+            # randseed keeps the random order stable across pages
+            seed = seed if seed is not None else random.randint(0, 2**31 - 1)
+            p_sort = f"{p_sort} randseed:{seed}"
+            other_params["random_seed"] = seed
         p_query = " ".join(x for x in [query, p_rating, p_sort] if x)
         query_params = {
             "tags": p_query,
-            "limit": count if count < PER_PAGE_MAX else PER_PAGE_MAX
+            "limit": count if count < self.PER_PAGE_MAX else self.PER_PAGE_MAX
         }
 
-        raw_tags = []
-        pages_to_load = (count // PER_PAGE_MAX) + \
-            (1 if count % PER_PAGE_MAX > 0 else 0)
-
-        for p in trange(1, pages_to_load + 1, desc="[LPP] Fetching tags"):
-            time.sleep(QUERY_DELAY)
-            query_params["page"] = p
-            json_response = self._send_api_request(ENDPOINT, query_params)
-            posts = json_response["posts"]
-            for post in posts:
-                post["tags"]["rating"] = post["rating"]
-            raw_tags += posts
-            if len(posts) < PER_PAGE_MAX:
-                break
-
-        raw_tags = [x["tags"] for x in raw_tags]
-        return TagData(
-            self.__class__.__name__,
-            p_query,
-            raw_tags[:count],
-            {}
+        return (
+            TagData(self.__class__.__name__, p_query, [], other_params),
+            query_params
         )
 
+    def _get_posts(self, json_response: dict[str:object]) -> list[dict[str:object]]:
+        return json_response["posts"]
+
+    def _extract_raw_tags(self, post: dict[str:object]) -> dict[str:object]:
+        # only keep non-empty categories that formatters actually use
+        raw_tags = {
+            k: post["tags"][k] for k in self.TAG_CATEGORIES
+            if post["tags"].get(k)
+        }
+        raw_tags["rating"] = post["rating"]
+        return raw_tags
+
+    def _parse_dump_row(self,
+                        row: dict[str:str],
+                        tag_categories: dict[str:int]) -> dict[str:object]:
+        if row.get("is_deleted") in ("t", "true", True):
+            return None
+        tags = {}
+        for tag in row["tag_string"].split():
+            category = self.DUMP_TAG_CATEGORIES.get(
+                tag_categories.get(tag, 0), "general"
+            )
+            tags.setdefault(category, []).append(tag)
+        return {"id": int(row["id"]), "rating": row["rating"], "tags": tags}
+
     def _convert_raw_tags(self, raw_tags: dict[str:object]) -> TagGroups:
         return TagGroups(
-            raw_tags["character"],
-            raw_tags["species"],
+            raw_tags.get("character", []),
+            raw_tags.get("species", []),
             raw_tags["rating"],
-            raw_tags["artist"],
-            raw_tags["general"],
-            raw_tags["copyright"] + raw_tags["meta"]
+            raw_tags.get("artist", []),
+            raw_tags.get("general", []),
+            raw_tags.get("copyright", []) + raw_tags.get("meta", [])
         )
 
     @formatter(Models.PDV56.value)
@@ -0,0 +1,97 @@
+from lpp.data import TagData, TagGroups, LppDataManager
+from collections import Counter
+from itertools import chain
+
+
+class TagStats:
+    # Tag frequencies of a collection, overall and per TagGroups category.
+    # Like TagIndex, it only ever counts the prompts past the ones it has
+    # already seen, so growing collections are never recounted.
+    __edges: tuple = None  # missing from stats pickled by older versions
+
+    def __init__(self):
+        self.query: str = None
+        self.__size: int = 0
+        self.__edges: tuple = None
+        self.__ratings: Counter = Counter()
+        self.__all: Counter = Counter()
+        self.__categories: dict[str:Counter] = {
+            x: Counter() for x in TagGroups.get_categories()
+        }
+
+    def __len__(self) -> int:
+        return self.__size
+
+    @property
+    def ratings(self) -> dict[str:int]:
+        return dict(self.__ratings)
+
+    @property
+    def categories(self) -> list[str]:
+        return [k for k, v in self.__categories.items() if v]
+
+    def update(self, tag_data: TagData, source: object):
+        new_items = tag_data.raw_tags[self.__size:]
+        groups = [source._convert_raw_tags(x) for x in new_items]
+        for category, counter in self.__categories.items():
+            tags = [getattr(x, category) for x in groups]
+            # Counter.update counts a flat iterable in C, which is much
+            # faster than bumping the counts one tag at a time
+            counter.update(chain.from_iterable(
+                [x] if isinstance(x, str) else x for x in tags
+            ))
+            if category != "rating":
+                self.__all.update(chain.from_iterable(tags))
+        self.__ratings.update(source.get_lpp_rating(x) for x in new_items)
+        self.__size += len(new_items)
+        self.query = tag_data.query
+        if tag_data.raw_tags:
+            self.__edges = (tag_data.raw_tags[0], tag_data.raw_tags[-1])
+        return self
+
+    def is_up_to_date(self, tag_data: TagData) -> bool:
+        # besides size and query, the first and last prompts have to match,
+        # which catches a collection overwritten with one of the same length
+        if self.__size != len(tag_data.raw_tags) \
+                or self.query != tag_data.query:
+            return False
+        return not tag_data.raw_tags \
+            or self.__edges == (tag_data.raw_tags[0], tag_data.raw_tags[-1])
+
+    def count(self, tag: str, category: str = None) -> int:
+        if category:
+            return self.__categories[category][tag]
+        return self.__all[tag]
+
+    def top(self, k: int = 10, category: str = None) -> list[tuple[str, int]]:
+        if category:
+            return self.__categories[category].most_common(k)
+        return self.__all.most_common(k)
+
+
+class TagStatsCache(LppDataManager):
+    def __init__(self, work_dir: str = "."):
+        super().__init__("tag_stats.dat", work_dir)
+
+    def save_item(self, name: str, data: TagStats) -> None:
+        with self._lock:
+            self._data[name] = data
+            self._dump_cache()
+
+    def get_stats(self,
+                  name: str,
+                  tag_data: TagData,
+                  source: object) -> TagStats:
+        stats = self._data.get(name)
+        if stats is None or not stats.is_up_to_date(tag_data):
+            stats = TagStats().update(tag_data, source)
+            self.save_item(name, stats)
+        return stats
+
+    # stats are derived from the collections, so they are simply recounted
+    # after an import instead of being carried along
+    def export_data(self) -> dict[str:object]:
+        return {}
+
+    def import_data(self, data: dict[str:object]) -> int:
+        return 0
@@ -0,0 +1,157 @@
+from lpp.data import TagData, TagGroups
+from lpp.permutation import SeededPermutation
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+import math
+import random
+
+
+class TagStrata:
+    # Posts grouped by their tags in one TagGroups category (one stratum per
+    # character, artist, ...), with every stratum's members further split by
+    # rating. Drawing a balanced batch then only looks at the strata, never
+    # at the whole collection. Like TagIndex, it is built incrementally.
+    TYPECODE = "I"
+    BALANCING = ("uniform", "sqrt", "proportional")
+    # posts without any tag in the category share a stratum of their own
+    UNTAGGED = ""
+    # steps of a Weyl sequence, whose every run of positions covers the
+    # strata in close to the right shares
+    GOLDEN_STEP = (math.sqrt(5) - 1) / 2
+
+    def __init__(self, category: str):
+        if category not in TagGroups.get_categories() or category == "rating":
+            raise ValueError(f"Can't stratify prompts by \"{category}\"")
+        self.category: str = category
+        self.__strata: dict[str:dict[str:array]] = {}
+        self.__size: int = 0
+        self.__members: dict[tuple:list[array]] = {}
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def update(self, tag_data: TagData, source: object):
+        if len(tag_data.raw_tags) > self.__size:
+            self.__members.clear()
+        for raw_tags in tag_data.raw_tags[self.__size:]:
+            tags = getattr(source._convert_raw_tags(raw_tags), self.category)
+            rating = source.get_lpp_rating(raw_tags)
+            # dict.fromkeys dedups in tag order; a set would make the strata
+            # order (and with it seeded draws) depend on PYTHONHASHSEED
+            for tag in dict.fromkeys(tags) or [self.UNTAGGED]:
+                by_rating = self.__strata.setdefault(tag, {})
+                members = by_rating.get(rating)
+                if members is None:
+                    members = by_rating[rating] = array(self.TYPECODE)
+                members.append(self.__size)
+            self.__size += 1
+        return self
+
+    @property
+    def strata(self) -> dict[str:int]:
+        return {
+            k: sum(len(x) for x in v.values())
+            for k, v in self.__strata.items()
+        }
+
+    def __get_members(self,
+                      allowed_ratings: list[str],
+                      items: set[int]) -> list[array]:
+        key = tuple(sorted(allowed_ratings or []))
+        # the strata of a rating selection are kept until new prompts arrive,
+        # so successive batches don't have to regroup the collection
+        if items is None and key in self.__members:
+            return self.__members[key]
+        strata = []
+        for _, by_rating in sorted(self.__strata.items()):
+            members = array(self.TYPECODE)
+            for rating, docs in sorted(by_rating.items()):
+                if not allowed_ratings or rating in allowed_ratings:
+                    members.extend(docs)
+            if items is not None:
+                members = array(self.TYPECODE,
+                                (x for x in members if x in items))
+            if members:
+                strata.append(members)
+        if items is None:
+            self.__members[key] = strata
+        return strata
+
+    @staticmethod
+    def __get_weight(size: int, balance: str) -> float:
+        if balance == "uniform":
+            return 1.0
+        if balance == "sqrt":
+            return math.sqrt(size)
+        if balance == "proportional":
+            return float(size)
+        raise ValueError(f"Unknown balancing \"{balance}\"")
+
+    def sample(self,
+               n: int,
+               allowed_ratings: list[str] = None,
+               balance: str = "uniform",
+               items: set[int] = None,
+               rng: object = random) -> list[int]:
+        strata = self.__get_members(allowed_ratings, items)
+        if not strata:
+            return []
+        weights = [self.__get_weight(len(x), balance) for x in strata]
+        total = sum(weights)
+
+        # every stratum first gets the whole part of its share of the batch
+        # and only the remainder is drawn at random, so a large batch covers
+        # all the strata instead of leaving about a third of them out
+        shares = [n * x / total for x in weights]
+        counts = [int(x) for x in shares]
+        remainder = n - sum(counts)
+        if remainder:
+            for i in rng.choices(range(len(strata)),
+                                 weights=[x - int(x) for x in shares],
+                                 k=remainder):
+                counts[i] += 1
+
+        chosen = []
+        for members, k in zip(strata, counts):
+            while k > len(members):
+                chosen.extend(members)
+                k -= len(members)
+            chosen.extend(rng.sample(members, k))
+        rng.shuffle(chosen)
+        return chosen
+
+    def sample_at(self,
+                  positions: list[int],
+                  allowed_ratings: list[str] = None,
+                  balance: str = "uniform",
+                  items: set[int] = None,
+                  key: str = "") -> list[int]:
+        # a position's prompt only depends on the key and the position, never
+        # on the rest of the batch: positions are spread over the strata by a
+        # Weyl sequence, and the n-th position landing in a stratum takes the
+        # n-th member of its seeded permutation. Finding n walks the earlier
+        # positions, which costs as much as the batch, not the collection.
+        strata = self.__get_members(allowed_ratings, items)
+        if not strata or not positions:
+            return []
+        weights = [self.__get_weight(len(x), balance) for x in strata]
+        bounds = list(accumulate(weights))
+        offset = random.Random(key).random()
+        wanted = set(positions)
+        found = {}
+        permutations = {}
+        counts = [0] * len(strata)
+        for position in range(max(wanted) + 1):
+            u = (offset + position * self.GOLDEN_STEP) % 1.0 * bounds[-1]
+            i = min(bisect_right(bounds, u), len(strata) - 1)
+            if position in wanted:
+                members = strata[i]
+                if i not in permutations:
+                    permutations[i] = SeededPermutation(
+                        len(members), f"{key}:{i}"
+                    )
+                found[position] = \
+                    members[permutations[i][counts[i] % len(members)]]
+            counts[i] += 1
+        return [found[x] for x in positions]
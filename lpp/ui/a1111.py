@@ -1,14 +1,168 @@
-from lpp.prompts import PromptPool, Prompts
+from lpp.prompts import PromptPool, MixedPromptPool, Prompts
 from lpp.data import TagData, FilterData, Ratings, CacheManager, FiltersManager
+from lpp.stats import TagStats, TagStatsCache
+from lpp.cooccurrence import TagCooccurrence
+from lpp.dedup import deduplicate
 from lpp.log import get_logger, LppMessageService, DefaultLppMessageService
-from lpp.sources.common import TagSourceBase
+from lpp.sources.common import TagSourceBase, FetchInterruptedError, FetchCancelledError, FetchProgress, CancellationToken
 from lpp.sources.utils import get_sources
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from dataclasses import dataclass, field
+from urllib.parse import urlparse
 import json
 import tempfile
+import threading
 
 logger = get_logger()
 
 
+@dataclass
+class FetchJob:
+    job_id: int
+    source: str
+    save_name: str
+    args: tuple
+    filters: list[str]
+    state: str = "Queued"
+    message: str = ""
+    progress: FetchProgress = None
+    cancel_token: CancellationToken = field(default_factory=CancellationToken)
+
+
+class FetchJobManager:
+    def __init__(self,
+                 sources: dict[str:TagSourceBase],
+                 cache_manager: CacheManager,
+                 max_workers: int = 4,
+                 per_host_limit: int = 1):
+        self.__sources = sources
+        self.__cache_manager = cache_manager
+        self.__executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix="lpp-fetch"
+        )
+        # jobs wait in a queue per host and only go to the pool once their
+        # host has a free slot, so a busy host never ties up the workers
+        # that jobs for idle hosts could use
+        self.__per_host_limit = per_host_limit
+        self.__host_queues: dict[str:deque] = {
+            host: deque()
+            for host in {self.__get_host(x) for x in sources.values()}
+        }
+        self.__host_running: dict[str:int] = {
+            host: 0 for host in self.__host_queues
+        }
+        self.__jobs: list[FetchJob] = []
+        self.__lock = threading.Lock()
+        self.__closed = False
+        # threading atexit hooks run before the interpreter joins the pool's
+        # workers (plain atexit ones only after), so exiting doesn't wait
+        # for long running jobs to finish
+        threading._register_atexit(self.shutdown)
+
+    @staticmethod
+    def __get_host(source: TagSourceBase) -> str:
+        return urlparse(source.ENDPOINT).netloc
+
+    @property
+    def jobs(self) -> list[FetchJob]:
+        return list(self.__jobs)
+
+    def submit(self, source: str, save_name: str, *args: object,
+               filters: list[str] = None) -> FetchJob:
+        if source not in self.__sources:
+            raise KeyError(f"No source named \"{source}\"")
+        if not save_name:
+            raise ValueError("Empty \"name\" parameter")
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError("Fetch jobs have been shut down")
+            job = FetchJob(len(self.__jobs) + 1, source, save_name, args,
+                           filters or [])
+            self.__jobs.append(job)
+            host = self.__get_host(self.__sources[source])
+            self.__host_queues[host].append(job)
+        self.__dispatch(host)
+        return job
+
+    def __dispatch(self, host: str) -> None:
+        with self.__lock:
+            while not self.__closed and self.__host_queues[host] \
+                    and self.__host_running[host] < self.__per_host_limit:
+                self.__host_running[host] += 1
+                self.__executor.submit(
+                    self.__run, self.__host_queues[host].popleft()
+                )
+
+    def cancel(self, job_id: int) -> None:
+        for job in self.__jobs:
+            if job.job_id == job_id:
+                job.cancel_token.cancel()
+
+    def cancel_all(self) -> None:
+        for job in self.__jobs:
+            job.cancel_token.cancel()
+
+    def shutdown(self) -> None:
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            for queue in self.__host_queues.values():
+                for job in queue:
+                    job.state = "Cancelled"
+                queue.clear()
+        # running fetches stop at their next cancellation check and keep
+        # their partial fetches for later
+        self.cancel_all()
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+    def __get_free_name(self, name: str) -> str:
+        # never overwrite collections the user already has
+        existing_names = self.__cache_manager.get_item_names()
+        free_name, i = name, 2
+        while free_name in existing_names:
+            free_name, i = f"{name} ({i})", i + 1
+        return free_name
+
+    def __run(self, job: FetchJob) -> None:
+        def track_progress(progress: FetchProgress) -> None:
+            job.progress = progress
+
+        source = self.__sources[job.source]
+        host = self.__get_host(source)
+        try:
+            if job.cancel_token.cancelled:
+                job.state = "Cancelled"
+                return
+            job.state = "Running"
+            tag_data = source.request_tags(
+                *job.args,
+                progress=track_progress,
+                cancel_token=job.cancel_token
+            )
+            with self.__lock:
+                job.save_name = self.__get_free_name(job.save_name)
+                self.__cache_manager.save_item(
+                    job.save_name, tag_data, job.filters
+                )
+            job.state = "Done"
+        except FetchCancelledError as e:
+            job.state = "Cancelled"
+            job.message = str(e)
+        except Exception as e:
+            job.state = "Failed"
+            job.message = f"{e} ({type(e).__name__})"
+            logger.warning(
+                f"Fetch job #{job.job_id} failed: {job.message}"
+            )
+        finally:
+            with self.__lock:
+                self.__host_running[host] -= 1
+            self.__dispatch(host)
+
+
 class LPP_A1111:
     def __init__(self, work_dir: str = ".",
                  derpi_api_key: str = None,
@@ -17,18 +171,64 @@ class LPP_A1111:
         self.__work_dir: str = work_dir
         if logging_level:
             logger.setLevel(logging_level)
-        self.__sources: dict[str:TagSourceBase] = get_sources(self.__work_dir)
+        self.__derpi_api_key: str = derpi_api_key
 
-        # TODO: need better way of handling this
-        if "Derpibooru" in self.__sources.keys():
-            self.__sources["Derpibooru"].set_api_key(derpi_api_key)
+        # sources, caches and the job manager are created on first use, so
+        # merely loading the extension doesn't parse configs or unpickle
+        # every saved collection
+        self.__lazy_lock = threading.RLock()
+        self.__loaded: dict[str:object] = {}
 
         self.__prompt_pool = None
-        self.__cache_manager: CacheManager = CacheManager(self.__work_dir)
-        self.__filters_manager: FiltersManager = FiltersManager(self.__work_dir)
+        self.__mix_pool: MixedPromptPool = None
+        self.__cooccurrence: dict[tuple:TagCooccurrence] = {}
 
         self.__messenger = messenger
         self.__collection_name = ""
+        self.__fetch_progress: FetchProgress = None
+        self.__cancel_token: CancellationToken = None
+
+    def __get_lazy(self, name: str, factory: callable) -> object:
+        with self.__lazy_lock:
+            if name not in self.__loaded:
+                self.__loaded[name] = factory()
+            return self.__loaded[name]
+
+    def __create_sources(self) -> dict[str:TagSourceBase]:
+        sources = get_sources(self.__work_dir)
+        # TODO: need better way of handling this
+        if "Derpibooru" in sources.keys():
+            sources["Derpibooru"].set_api_key(self.__derpi_api_key)
+        return sources
+
+    @property
+    def __sources(self) -> dict[str:TagSourceBase]:
+        return self.__get_lazy("sources", self.__create_sources)
+
+    @property
+    def __cache_manager(self) -> CacheManager:
+        return self.__get_lazy(
+            "cache_manager", lambda: CacheManager(self.__work_dir)
+        )
+
+    @property
+    def __filters_manager(self) -> FiltersManager:
+        return self.__get_lazy(
+            "filters_manager", lambda: FiltersManager(self.__work_dir)
+        )
+
+    @property
+    def __stats_cache(self) -> TagStatsCache:
+        return self.__get_lazy(
+            "stats_cache", lambda: TagStatsCache(self.__work_dir)
+        )
+
+    @property
+    def __job_manager(self) -> FetchJobManager:
+        return self.__get_lazy(
+            "job_manager",
+            lambda: FetchJobManager(self.__sources, self.__cache_manager)
+        )
 
     @property
     def source_names(self) -> list[str]:
@@ -44,7 +244,16 @@ class LPP_A1111:
 
     @tag_data.setter
     def tag_data(self, value: TagData) -> None:
-        self.__prompt_pool = PromptPool(value, self.__work_dir)
+        self.__prompt_pool = PromptPool(value, self.__work_dir, self.__sources)
+        self.__mix_pool = None
+
+    @property
+    def supported_models(self) -> list[str]:
+        pools = self.__mix_pool.pools if self.__mix_pool \
+            else [self.__prompt_pool] if self.__prompt_pool else []
+        return list(dict.fromkeys(
+            m for x in pools for m in x.source.supported_models
+        ))
 
     @property
     def prompt_collections(self) -> list[str]:
@@ -56,12 +265,25 @@ class LPP_A1111:
 
     @property
     def status(self) -> str:
-        n_prompts = self.__prompt_pool.prompts_count\
-            if self.__prompt_pool else 0
+        pool = self.__mix_pool or self.__prompt_pool
+        n_prompts = pool.prompts_count if pool else 0
         return f"\"{self.__collection_name}\" <b>[{n_prompts}]</b> ✅" \
             if n_prompts > 0 \
             else "No prompts loaded 🛑"
 
+    @property
+    def collection_name(self) -> str:
+        return self.__collection_name
+
+    @property
+    def collection_version(self) -> str:
+        pool = self.__mix_pool or self.__prompt_pool
+        return pool.version if pool and pool.prompts_count > 0 else None
+
+    @property
+    def fetch_status(self) -> str:
+        return str(self.__fetch_progress) if self.__fetch_progress else ""
+
     def __try_exec_command(
         self, lpp_method: callable, success_msg: str,
         failure_msg: str, *args: object
@@ -74,12 +296,36 @@ class LPP_A1111:
                 f"{failure_msg} {str(e)} ({type(e).__name__})"
             )
 
-    def try_save_prompts(self, name: str, filters: list[str]) -> None:
+    def __check_single_collection(self) -> None:
+        # a mix has no tag data of its own to save or select from, and the
+        # collection loaded before it isn't what the status shows
+        if self.__mix_pool:
+            raise ValueError(
+                "Collections are being mixed, load a single collection first."
+            )
+        if not self.__prompt_pool:
+            raise ValueError("No prompts are currently loaded.")
+
+    def try_save_prompts(self, name: str, filters: list[str],
+                         dedup_threshold: float = None) -> None:
+        def save_tag_data(name: str, filters: list[str]) -> None:
+            self.__check_single_collection()
+            if dedup_threshold:
+                source = self.__sources[self.tag_data.source]
+                tag_data = deduplicate(self.tag_data, source, dedup_threshold)
+                stats = TagStats().update(tag_data, source)
+            else:
+                # the pool keeps counting new prompts, so the saved stats
+                # must be a snapshot
+                tag_data = self.tag_data
+                stats = deepcopy(self.__prompt_pool.stats)
+            self.__cache_manager.save_item(name, tag_data, filters)
+            self.__stats_cache.save_item(name, stats)
         self.__try_exec_command(
-            self.__cache_manager.save_item,
+            save_tag_data,
             f"Successfully saved \"{name}\"",
             f"Failed to save \"{name}\":",
-            name, self.tag_data, filters
+            name, filters
         )
 
     def try_load_prompts(self, name: str) -> None:
@@ -93,9 +339,67 @@ class LPP_A1111:
             name
         )
 
+    def try_select_prompts(self, query: str) -> None:
+        def select_tag_data(query: str) -> None:
+            self.__check_single_collection()
+            tag_data = self.__prompt_pool.select(query)
+            if not tag_data.raw_tags:
+                raise ValueError("No prompts match the query.")
+            self.tag_data = tag_data
+            self.__collection_name = f"{self.__collection_name} [{query}]"
+        self.__try_exec_command(
+            select_tag_data,
+            f"Selected prompts matching \"{query}\"",
+            f"Failed to select prompts matching \"{query}\":",
+            query
+        )
+
+    def try_combine_prompts(self, operation: str, names: list[str]) -> None:
+        def combine_tag_data(operation: str, names: list[str]) -> None:
+            tag_data = self.__cache_manager.combine(operation, names)
+            if not tag_data.raw_tags:
+                raise ValueError("The result has no prompts.")
+            self.tag_data = tag_data
+            self.__collection_name = tag_data.query
+        self.__try_exec_command(
+            combine_tag_data,
+            f"Loaded {operation} of {len(names or [])} collections",
+            "Failed to combine collections:",
+            operation, names or []
+        )
+
+    def try_load_mix(self, names: list[str], weights: list[float]) -> None:
+        def load_mix(names: list[str], weights: list[float]) -> None:
+            if not names:
+                raise ValueError("No collections to mix.")
+            if len(weights) != len(names):
+                raise ValueError(
+                    f"Got {len(weights)} weights for {len(names)} collections."
+                )
+            self.__mix_pool = MixedPromptPool(
+                [(PromptPool(self.__cache_manager[x], self.__work_dir,
+                             self.__sources), w)
+                 for x, w in zip(names, weights)],
+                self.__work_dir
+            )
+            total = sum(weights)
+            self.__collection_name = " + ".join(
+                f"{x} {w / total:.0%}" for x, w in zip(names, weights) if w > 0
+            )
+        self.__try_exec_command(
+            load_mix,
+            f"Mixing {len(names or [])} collections",
+            "Failed to mix collections:",
+            names or [], weights
+        )
+
     def try_delete_prompts(self, name: str) -> None:
+        def delete_tag_data(name: str) -> None:
+            self.__cache_manager.delete_item(name)
+            if name in self.__stats_cache.get_item_names():
+                self.__stats_cache.delete_item(name)
         self.__try_exec_command(
-            self.__cache_manager.delete_item,
+            delete_tag_data,
             f"Successfully deleted \"{name}\"",
             f"Failed to delete \"{name}\":",
             name
@@ -141,10 +445,36 @@ class LPP_A1111:
             self.__messenger.warning(f"Filed to load filters: {', '.join(failed_filters)}")
         return filters
 
-    def try_send_request(self, source: str, *args: object) -> None:
+    def try_send_request(self, source: str, *args: object,
+                         progressive: bool = False) -> None:
+        def track_progress(progress: FetchProgress) -> None:
+            self.__fetch_progress = progress
+
+        def use_partial_tag_data(tag_data: TagData) -> None:
+            # the pool shares tag_data with the fetch, so it keeps growing
+            # as new pages arrive
+            if self.tag_data is not tag_data:
+                self.tag_data = tag_data
+                self.__collection_name = "from query (loading)"
+
         def load_new_tag_data(*args: object) -> None:
-            self.tag_data = self.__sources[source].request_tags(*args)
-            self.__collection_name = "from query"
+            try:
+                self.tag_data = self.__sources[source].request_tags(
+                    *args,
+                    progress=track_progress,
+                    cancel_token=self.__cancel_token,
+                    on_page=use_partial_tag_data if progressive else None
+                )
+                self.__collection_name = "from query"
+            except FetchInterruptedError as e:
+                # partially fetched prompts are still perfectly usable
+                if e.tag_data.raw_tags:
+                    self.tag_data = e.tag_data
+                    self.__collection_name = "from query (partial)"
+                raise
+
+        self.__cancel_token = CancellationToken()
+        self.__fetch_progress = None
         self.__try_exec_command(
             load_new_tag_data,
             f"Successfully fetched tags from \"{source}\"",
@@ -152,17 +482,90 @@ class LPP_A1111:
             *args
         )
 
-    def try_get_tag_data_markdown(self, name: str) -> str:
+    def cancel_request(self) -> None:
+        if self.__cancel_token:
+            self.__cancel_token.cancel()
+
+    def try_queue_request(self, source: str, name: str, filters: list[str],
+                          *args: object) -> None:
+        self.__try_exec_command(
+            lambda *args: self.__job_manager.submit(
+                source, name, *args, filters=filters
+            ),
+            f"Queued \"{name}\" fetch from \"{source}\"",
+            f"Failed to queue \"{name}\":",
+            *args
+        )
+
+    def cancel_jobs(self) -> None:
+        self.__job_manager.cancel_all()
+
+    def shutdown(self) -> None:
+        self.cancel_request()
+        with self.__lazy_lock:
+            job_manager = self.__loaded.get("job_manager")
+        if job_manager:
+            job_manager.shutdown()
+
+    @property
+    def query_params_revision(self) -> int:
+        return sum(x.query_params_revision for x in self.__sources.values())
+
+    @property
+    def jobs_markdown(self) -> str:
+        jobs = self.__job_manager.jobs
+        if not jobs:
+            return "No queued fetches"
+        rows = [
+            "| # | Source | Query | Save as | Status | Progress |",
+            "|---|---|---|---|---|---|"
+        ]
+        for job in reversed(jobs):
+            status = f"{job.state}: {job.message}" if job.message \
+                else job.state
+            progress = str(job.progress) if job.progress else ""
+            query = str(job.args[0]).replace("|", "\\|") if job.args else ""
+            rows.append(
+                f"| {job.job_id} | {job.source} | `{query}` "
+                f"| {job.save_name} | {status} | {progress} |"
+            )
+        return "\n".join(rows)
+
+    def get_tag_stats(self, name: str) -> TagStats:
+        target = self.__cache_manager.peek(name)
+        return self.__stats_cache.get_stats(
+            name, target, self.__sources[target.source]
+        )
+
+    def get_tag_cooccurrence(self, name: str,
+                             vocab_size: int = 2000) -> TagCooccurrence:
+        # built on demand only, as it's considerably heavier than the stats
+        target = self.__cache_manager.peek(name)
+        cooccurrence = self.__cooccurrence.get((name, vocab_size))
+        if cooccurrence is None or not cooccurrence.is_up_to_date(target):
+            cooccurrence = TagCooccurrence(
+                target, self.__sources[target.source], vocab_size
+            )
+            self.__cooccurrence[(name, vocab_size)] = cooccurrence
+        return cooccurrence
+
+    def try_get_tag_data_markdown(self, name: str, top_k: int = 8) -> str:
         try:
-            target = self.__cache_manager[name]
+            target = self.__cache_manager.peek(name)
+            stats = self.__stats_cache.get_stats(
+                name, target, self.__sources[target.source]
+            )
             ratings = {
                 Ratings.SAFE.value: 0,
                 Ratings.QUESTIONABLE.value: 0,
-                Ratings.EXPLICIT.value: 0
+                Ratings.EXPLICIT.value: 0,
+                **stats.ratings
             }
-            source = self.__sources[target.source]
-            for item in target.raw_tags:
-                ratings[source.get_lpp_rating(item)] += 1
+            top_tags = "\n\n".join(
+                [f"{x.capitalize()}: " + ", ".join(
+                    [f"`{t}` ({n})" for t, n in stats.top(top_k, x)]
+                ) for x in stats.categories if x != "rating"]
+            )
             filter_str = "Filters: " +\
                 " ".join([f"`{x}`" for x in target.other_params["filters"]])
             other_params = ", ".join(
@@ -178,16 +581,29 @@ Safe: **{ratings[Ratings.SAFE.value]}** | Questionable: **{ratings[Ratings.QUEST
 {target.query}
 ```
 """
-            return main_info + filter_str + "\n" + other_params
+            return main_info + top_tags + "\n\n" + filter_str + "\n" \
+                + other_params
         except KeyError:
             return "no collection selected"
 
     def try_choose_prompts(self,
                            n: int = 1,
                            allowed_ratings: list[str] = None,
+                           dedup_threshold: float = None,
+                           stratify_by: str = None,
+                           balance: str = "uniform",
+                           seed: int = None
                            ) -> Prompts:
         try:
-            return self.__prompt_pool.choose_prompts(n, allowed_ratings)
+            if self.__mix_pool:
+                return self.__mix_pool.choose_prompts(
+                    n, allowed_ratings, stratify_by, balance, seed,
+                    dedup_threshold
+                )
+            return self.__prompt_pool.choose_prompts(
+                n, allowed_ratings, dedup_threshold=dedup_threshold,
+                stratify_by=stratify_by, balance=balance, seed=seed
+            )
         # HACK: these should really be errors and not warnings, but effing
         # A1111 or Gradio just refuses to display them. It is important to
         # explicitly alert the user about these problems, so for now I'll
@@ -1,20 +1,112 @@
 import sys
 import os.path as path
+from collections import OrderedDict
 from copy import deepcopy
 
 LPP_ROOT_DIR = path.join(path.dirname(__file__), "..", "..")
 sys.path.append(LPP_ROOT_DIR)
 
-from lpp.sources.common import TagSourceBase
+from lpp.sources.common import TagSourceBase, CancellationToken, FetchProgress
 from lpp.sources.derpibooru import Derpibooru
 from lpp.sources.e621 import E621
 from lpp.sources.danbooru import Danbooru
 from lpp.sources.utils import get_sources
-from lpp.prompts import PromptPool
-from lpp.data import FilterData, CacheManager
-
-lpp_sources = get_sources(LPP_ROOT_DIR)
-cm = CacheManager(LPP_ROOT_DIR)
+from lpp.prompts import PromptPool, MixedPromptPool
+from lpp.strata import TagStrata
+from lpp.data import TagData, FilterData, CacheManager
+from lpp.log import get_logger
+
+logger = get_logger()
+# parsing the source configs and unpickling the tag cache are both left
+# for the first node that needs them, so they don't slow down ComfyUI's boot
+_lpp_sources: dict[str:TagSourceBase] = None
+_cache_manager: CacheManager = None
+
+
+def get_lpp_sources() -> dict[str:TagSourceBase]:
+    global _lpp_sources
+    if _lpp_sources is None:
+        _lpp_sources = get_sources(LPP_ROOT_DIR)
+    return _lpp_sources
+
+
+def get_supported_models() -> list[str]:
+    # every source's formats, so nodes fed by any source can offer the
+    # source specific ones too; sources without a format use their default
+    return list(dict.fromkeys(
+        m for x in get_lpp_sources().values() for m in x.supported_models
+    ))
+
+
+def get_cache_manager() -> CacheManager:
+    global _cache_manager
+    if _cache_manager is None:
+        _cache_manager = CacheManager(LPP_ROOT_DIR)
+    return _cache_manager
+
+
+class PromptPoolCache:
+    # Shares one PromptPool per collection version between all nodes and
+    # queue runs, so indexes, strata and sources are only ever built once.
+    # Loaders hand out fresh copies of a collection on every run, which is
+    # why pools are looked up by version and not by the TagData object.
+    def __init__(self, max_size: int = 8):
+        self.__max_size = max_size
+        self.__pools: OrderedDict[str:PromptPool] = OrderedDict()
+        self.__seen: OrderedDict[int:tuple[TagData, PromptPool]] = \
+            OrderedDict()
+
+    def __trim(self, cache: OrderedDict) -> None:
+        while len(cache) > self.__max_size:
+            cache.popitem(last=False)
+
+    def get(self, tag_data: TagData) -> PromptPool:
+        seen = self.__seen.get(id(tag_data))
+        if seen and seen[0] is tag_data:
+            self.__seen.move_to_end(id(tag_data))
+            return seen[1]
+
+        pool = PromptPool(tag_data, LPP_ROOT_DIR, get_lpp_sources())
+        version = pool.version
+        if version in self.__pools:
+            pool = self.__pools[version]
+            self.__pools.move_to_end(version)
+        else:
+            self.__pools[version] = pool
+            self.__trim(self.__pools)
+        # keeping the TagData alive makes sure its id isn't reused
+        self.__seen[id(tag_data)] = (tag_data, pool)
+        self.__trim(self.__seen)
+        return pool
+
+    def get_version(self, name: str) -> str:
+        cm = get_cache_manager()
+        return self.get(cm.peek(name)).version if name in cm.get_item_names() \
+            else ""
+
+
+prompt_pools = PromptPoolCache()
+
+
+class ComfyCancellationToken(CancellationToken):
+    @property
+    def cancelled(self) -> bool:
+        import comfy.model_management
+        return super().cancelled \
+            or comfy.model_management.processing_interrupted()
+
+
+class ComfyProgress:
+    def __init__(self, node_id: str = None):
+        self.__node_id = node_id
+        self.__bar = None
+
+    def __call__(self, progress: FetchProgress) -> None:
+        from comfy.utils import ProgressBar
+        if not self.__bar:
+            self.__bar = ProgressBar(progress.posts_total, self.__node_id)
+        self.__bar.update_absolute(progress.posts_done)
+        logger.info(str(progress))
 
 
 class ComfyTagSourceBase:
@@ -35,9 +127,9 @@ class ComfyTagSourceBase:
             "count": ("INT", {
                 "default": 100,
                 "min": 5,
-                "max": 1500,
+                "max": 1000000,
                 "step": 5,
-                "display": "slider"
+                "display": "number"
             }),
             "send_request": ("BOOLEAN", {
                 "default": False
@@ -46,6 +138,15 @@ class ComfyTagSourceBase:
         "optional": {
             "prompt_template": ("STRING", {
                 "multiline": False
+            }),
+            "stratify_by": (["None", "character", "artist", "species"],),
+            "balance": (list(TagStrata.BALANCING),),
+            # optional and last, so widget values of workflows saved before
+            # it existed still line up
+            "seed": ("INT", {
+                "default": 0,
+                "min": 0,
+                "max": 0xffffffffffffffff
             })
         }
     }
@@ -59,18 +160,30 @@ class ComfyTagSourceBase:
                    format,
                    tag_filter,
                    send_request,
+                   seed=0,
                    tag_data=None,
                    prompt_template="",
+                   stratify_by="None",
+                   balance="uniform",
+                   unique_id=None,
                    **query_args):
         if tag_data:
-            self._prompt_pool = PromptPool(tag_data, LPP_ROOT_DIR)
+            self._prompt_pool = prompt_pools.get(tag_data)
         elif not self._prompt_pool or send_request:
-            self._prompt_pool = PromptPool(
-                    self._source.request_tags(**query_args),
-                    LPP_ROOT_DIR
+            self._prompt_pool = prompt_pools.get(
+                    self._source.request_tags(
+                        **query_args,
+                        progress=ComfyProgress(unique_id),
+                        cancel_token=ComfyCancellationToken()
+                    )
             )
         tf = FilterData.from_string(tag_filter, ",")
-        chosen_prompts = self._prompt_pool.choose_prompts(1, None)
+        chosen_prompts = self._prompt_pool.choose_prompts(
+            1, None,
+            stratify_by=stratify_by if stratify_by != "None" else None,
+            balance=balance,
+            seed=seed
+        )
         prompt = chosen_prompts\
             .apply_formatting(format)\
             .extra_tag_formatting(
@@ -82,18 +195,33 @@ class ComfyTagSourceBase:
         return (prompt, (self._prompt_pool.tag_data, tf))
 
     @classmethod
-    def IS_CHANGED(self, *args, **kwargs):
-        return float("NaN")
+    def IS_CHANGED(self,
+                   *args,
+                   seed=0,
+                   send_request=False,
+                   tag_filter="",
+                   format="",
+                   prompt_template="",
+                   **kwargs):
+        # prompts are a pure function of these and the collection, so as
+        # long as they stay the same ComfyUI can serve the node and
+        # everything after it from cache. Linked inputs like tag_data never
+        # reach IS_CHANGED; a changed collection is caught by the upstream
+        # loader's IS_CHANGED, which reruns this node along with it.
+        if send_request:
+            return float("NaN")
+        return f"{seed}:{tag_filter}:{format}:{prompt_template}"
 
     @classmethod
     def INPUT_TYPES(cls):
         types = deepcopy(cls.tag_source_input_types_base)
-        s = lpp_sources[cls.SOURCE_NAME]
+        s = get_lpp_sources()[cls.SOURCE_NAME]
 
         for p, get_values_func in s.extra_query_params.items():
             types["required"][p] = (get_values_func(),)
         types["required"]["format"] = (s.supported_models,)
         types["optional"]["tag_data"] = (f"LPP_TAG_DATA_{cls.SOURCE_NAME.upper()}",)
+        types["hidden"] = {"unique_id": "UNIQUE_ID"}
         return types
 
 
@@ -118,6 +246,144 @@ class ComfyDanbooru(ComfyTagSourceBase):
         ComfyTagSourceBase.__init__(self, Danbooru(LPP_ROOT_DIR))
 
 
+class LPPMixer:
+    MIX_SLOTS = 3
+
+    def __init__(self):
+        self.__mix_key: tuple = None
+        self.__mix_pool: MixedPromptPool = None
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        types = {"required": {}, "optional": {}}
+        for i in range(1, cls.MIX_SLOTS + 1):
+            types["required"][f"collection_{i}"] = (
+                ["None"] + get_cache_manager().get_item_names(),
+            )
+            types["required"][f"weight_{i}"] = ("FLOAT", {
+                "default": 1.0,
+                "min": 0.0,
+                "max": 100.0,
+                "step": 0.05
+            })
+        types["required"]["format"] = (get_supported_models(),)
+        types["required"]["tag_filter"] = ("STRING", {"multiline": False})
+        types["optional"]["prompt_template"] = ("STRING", {
+            "multiline": False
+        })
+        types["optional"]["seed"] = ("INT", {
+            "default": 0,
+            "min": 0,
+            "max": 0xffffffffffffffff
+        })
+        return types
+
+    RETURN_TYPES = ("STRING",)
+    RETURN_NAMES = ("Prompt",)
+    CATEGORY = "LPP"
+    FUNCTION = "get_prompt"
+
+    def get_prompt(self, format, tag_filter, seed=0, prompt_template="",
+                   **slots):
+        mix = tuple(
+            (slots[f"collection_{i}"], slots[f"weight_{i}"])
+            for i in range(1, self.MIX_SLOTS + 1)
+            if slots[f"collection_{i}"] != "None"
+        )
+        # the mix is only rebuilt when its collections or weights change
+        cm = get_cache_manager()
+        pools = [(prompt_pools.get(cm.peek(name)), w) for name, w in mix]
+        mix_key = tuple((x.version, w) for x, w in pools)
+        if mix_key != self.__mix_key:
+            self.__mix_pool = MixedPromptPool(pools, LPP_ROOT_DIR)
+            self.__mix_key = mix_key
+        tf = FilterData.from_string(tag_filter, ",")
+        prompt = self.__mix_pool.choose_prompts(1, None, seed=seed)\
+            .apply_formatting(format)\
+            .extra_tag_formatting(
+                lambda x: x.filter(tf).escape_parentheses()
+            )\
+            .apply_template(format, prompt_template)\
+            .sanitize()\
+            .first()
+        return (prompt,)
+
+    @classmethod
+    def IS_CHANGED(self,
+                   *args,
+                   seed=0,
+                   tag_filter="",
+                   format="",
+                   prompt_template="",
+                   **slots):
+        versions = [
+            prompt_pools.get_version(slots[f"collection_{i}"])
+            for i in range(1, self.MIX_SLOTS + 1)
+        ]
+        return f"{seed}:{versions}:{tag_filter}:{format}:{prompt_template}"
+
+
+class LPPBatchPrompts:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "tag_data": ("LPP_TAG_DATA",),
+                "count": ("INT", {
+                    "default": 16,
+                    "min": 1,
+                    "max": 4096,
+                    "display": "number"
+                }),
+                "format": (get_supported_models(),),
+                "seed": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 0xffffffffffffffff
+                })
+            },
+            "optional": {
+                "prompt_template": ("STRING", {
+                    "multiline": False
+                }),
+                "stratify_by": (["None", "character", "artist", "species"],),
+                "balance": (list(TagStrata.BALANCING),)
+            }
+        }
+
+    RETURN_TYPES = ("STRING",)
+    RETURN_NAMES = ("Prompts",)
+    OUTPUT_IS_LIST = (True,)
+    CATEGORY = "LPP"
+    FUNCTION = "get_prompts"
+
+    def get_prompts(self,
+                    tag_data,
+                    count,
+                    format,
+                    seed=0,
+                    prompt_template="",
+                    stratify_by="None",
+                    balance="uniform"):
+        tag_data, tf = tag_data
+        # the whole batch goes through the pipeline at once, instead of one
+        # node execution per prompt
+        prompts = prompt_pools.get(tag_data).choose_prompts(
+            count, None,
+            stratify_by=stratify_by if stratify_by != "None" else None,
+            balance=balance,
+            seed=seed
+        )\
+            .apply_formatting(format)\
+            .extra_tag_formatting(
+                lambda x: x.filter(tf).escape_parentheses()
+            )\
+            .apply_template(format, prompt_template)\
+            .sanitize()\
+            .as_list()
+        return (prompts,)
+
+
 class LPPSaver:
     @classmethod
     def INPUT_TYPES(self):
@@ -138,6 +404,7 @@ class LPPSaver:
     OUTPUT_NODE = True
 
     def save_tag_data(self, tag_data, name, overwrite):
+        cm = get_cache_manager()
         existing_names = cm.get_item_names()
         if (name in existing_names and overwrite) \
                 or name not in existing_names:
@@ -153,7 +420,7 @@ class LPPLoaderBase:
         return {
             "required": {
                 "collection_name": (
-                    cm.get_item_names(lambda k, v: (v.source == cls.SOURCE_NAME)),
+                    get_cache_manager().get_item_names(lambda k, v: (v.source == cls.SOURCE_NAME)),
                 )
             }
         }
@@ -162,7 +429,12 @@ class LPPLoaderBase:
     FUNCTION = "load_tag_data"
 
     def load_tag_data(self, collection_name):
-        return (cm[collection_name],)
+        return (get_cache_manager()[collection_name],)
+
+    @classmethod
+    def IS_CHANGED(self, collection_name):
+        # only reload when the saved collection actually changed
+        return prompt_pools.get_version(collection_name)
 
 
 class LPPLoaderDerpibooru(LPPLoaderBase):
@@ -185,7 +457,7 @@ class LPPDeleter:
     def INPUT_TYPES(self):
         return {
             "required": {
-                "collection_name": (cm.get_item_names(),)
+                "collection_name": (get_cache_manager().get_item_names(),)
             }
         }
     RETURN_TYPES = ()
@@ -194,5 +466,5 @@ class LPPDeleter:
     OUTPUT_NODE = True
 
     def delete_tag_data(self, collection_name):
-        cm.delete_item(collection_name)
+        get_cache_manager().delete_item(collection_name)
         return {}
@@ -1,13 +1,16 @@
 from lpp.ui.a1111 import LPP_A1111
 from lpp.data import Models, FilterData, Ratings
 from lpp.log import DefaultLppMessageService
+from lpp.strata import TagStrata
 from dataclasses import dataclass
+from contextvars import copy_context
 from modules import scripts
 from modules import shared
 from modules import script_callbacks
 from modules.ui_components import InputAccordion, FormRow, FormColumn, FormGroup, ToolButton
 import gradio as gr
 import logging
+import threading
 
 base_dir = scripts.basedir()
 
@@ -62,6 +65,33 @@ def on_ui_settings():
                               gr.Textbox,
                               {"interactive": True, "type": "password"}
                               ).needs_reload_ui(),
+        "lpp_progressive_fetch":
+            shared.OptionInfo(True,
+                              "Start using fetched prompts while the rest of the query is still loading",
+                              gr.Checkbox),
+        "lpp_dedup_threshold":
+            shared.OptionInfo(0,
+                              "Skip near-duplicate prompts at this tag similarity (0 to keep all)",
+                              gr.Slider,
+                              {"minimum": 0, "maximum": 1, "step": 0.05}),
+        "lpp_stratify_by":
+            shared.OptionInfo("None",
+                              "Balance batches over this tag category",
+                              gr.Radio,
+                              {"choices": ["None", "character", "artist", "species"]}),
+        "lpp_stratify_balance":
+            shared.OptionInfo("uniform",
+                              "How to weigh the tags of that category",
+                              gr.Radio,
+                              {"choices": list(TagStrata.BALANCING)}),
+        "lpp_seeded_prompts":
+            shared.OptionInfo(False,
+                              "Choose prompts from the image seed, so the same seed gives the same prompts",
+                              gr.Checkbox),
+        "lpp_dedup_on_save":
+            shared.OptionInfo(False,
+                              "Also drop near-duplicate prompts when saving collections",
+                              gr.Checkbox),
         "lpp_editors_count":
             shared.OptionInfo(3,
                               "Number of filter editor panels",
@@ -96,6 +126,9 @@ lpp: LPP_A1111 = LPP_A1111(
     get_opt("lpp_logging_level", None),
     A1111LppMessageService()
 )
+# a reloaded extension gets a new LPP_A1111, so the old one's fetch jobs
+# have to be stopped
+script_callbacks.on_script_unloaded(lpp.shutdown)
 
 
 class ConfirmationDialog:
@@ -208,7 +241,12 @@ class FilterEditor:
 class QueryPanel:
     panel: gr.Group
     send_btn: gr.Button
+    stop_btn: gr.Button
+    progress_info: gr.Markdown
+    queue_name: gr.Textbox
+    queue_btn: gr.Button
     params: list[object]
+    extra_params: dict[object:callable]
 
 
 def get_query_panels(active_panel_name: str):
@@ -226,28 +264,41 @@ def get_query_panels(active_panel_name: str):
                 )
             with FormRow():
                 with FormColumn():
-                    prompts_count = gr.Slider(
+                    prompts_count = gr.Number(
                         label="Number of Prompts to Load",
                         minimum=5,
-                        maximum=1500,
-                        step=5,
+                        maximum=1000000,
+                        precision=0,
                         value=100
                     )
                 with FormColumn():
                     with FormRow():
-                        extra_controls = []
+                        extra_controls = {}
                         for p, get_values_func in source.extra_query_params.items():
                             control = gr.Dropdown(
                                 label=get_values_func.display_name,
                                 choices=get_values_func(),
                                 value=get_values_func()[0]
                             )
-                            extra_controls.append(control)
+                            extra_controls[control] = get_values_func
             with FormRow():
                 send_btn = gr.Button(value="Send")
-            controls = [query, prompts_count] + extra_controls
-            set_no_config(*controls)
-            panels[name] = QueryPanel(panel, send_btn, controls)
+                stop_btn = gr.Button(value="Stop", variant="stop")
+            with FormRow():
+                progress_info = gr.Markdown()
+            with FormRow():
+                queue_name = gr.Textbox(
+                    placeholder="Collection name to save queued fetch as",
+                    show_label=False,
+                    scale=8
+                )
+                queue_btn = gr.Button(value="Queue", scale=2, min_width=80)
+            controls = [query, prompts_count] + list(extra_controls)
+            set_no_config(queue_name, *controls)
+            panels[name] = QueryPanel(
+                panel, send_btn, stop_btn, progress_info,
+                queue_name, queue_btn, controls, extra_controls
+            )
     return panels
 
 
@@ -329,6 +380,45 @@ class Scripts(scripts.Script):
                                 scale=2,
                                 min_width=120
                             )
+                        with FormRow():
+                            local_query = gr.Textbox(
+                                label="Select From Loaded Prompts",
+                                lines=1,
+                                max_lines=1,
+                                placeholder="solo -text (pony OR horse) rating:s"
+                            )
+                            select_prompts_btn = ToolButton("🔎")
+                        with FormRow():
+                            combine_collections = gr.Dropdown(
+                                label="Combine Collections",
+                                choices=lpp.prompt_collections,
+                                multiselect=True,
+                                scale=7
+                            )
+                            combine_operation = gr.Dropdown(
+                                label="Operation",
+                                choices=["Union", "Intersection", "Difference"],
+                                value="Union",
+                                scale=3,
+                                min_width=120
+                            )
+                            combine_btn = ToolButton("🔗")
+                        with FormRow():
+                            mix_collections = gr.Dropdown(
+                                label="Mix Collections",
+                                choices=lpp.prompt_collections,
+                                multiselect=True,
+                                scale=7
+                            )
+                            mix_weights = gr.Textbox(
+                                label="Weights",
+                                lines=1,
+                                max_lines=1,
+                                placeholder="60, 30, 10",
+                                scale=3,
+                                min_width=120
+                            )
+                            mix_btn = ToolButton("⚖")
                         # Booru Query & Promts Info Panels --------------------
                         with FormRow(variant="panel", elem_id="lpp-query-panel"):
                             with gr.Accordion(
@@ -342,6 +432,25 @@ class Scripts(scripts.Script):
                                     elem_id="lpp-chbox-group"
                                 )
                                 self.query_panels = get_query_panels(source.value)
+                                # polled, so choices fetched in the background
+                                # (like Derpibooru user filters) show up
+                                # without reloading the UI
+                                params_revision = gr.Number(
+                                    lambda: lpp.query_params_revision,
+                                    every=5,
+                                    visible=False
+                                )
+                                with gr.Accordion(
+                                    label="🗃 Queued fetches",
+                                    open=False
+                                ):
+                                    jobs_info = gr.Markdown(
+                                        lambda: lpp.jobs_markdown, every=2
+                                    )
+                                    cancel_jobs_btn = gr.Button(
+                                        value="Cancel all queued fetches",
+                                        variant="stop"
+                                    )
 
                     # Filtering Options Panel ---------------------------------
                     with FormColumn():
@@ -428,30 +537,85 @@ class Scripts(scripts.Script):
             # A1111 will cache ui control values in ui_config.json and "freeze"
             # them without this attribute.
             set_no_config(source, prompts_format, prompts_manager_input,
-                          filters, fe_filter_name)
+                          filters, fe_filter_name, combine_collections,
+                          mix_collections)
 
             # Prompt Manager Event Handlers ###################################
             # Send Query Buttons
             def send_request_click(source, prompts_format, *params):
                 models = ["Auto"] + lpp.sources[source].supported_models
-                lpp.try_send_request(source, *params)
-                return (
+                # run the fetch in a thread (with gradio's context, so
+                # messages still pop up) to report live progress meanwhile
+                fetch = threading.Thread(
+                    target=copy_context().run,
+                    args=(lpp.try_send_request, source, *params),
+                    kwargs={
+                        "progressive": get_opt("lpp_progressive_fetch", True)
+                    }
+                )
+                fetch.start()
+                while fetch.is_alive():
+                    yield (lpp.status, gr.update(), lpp.fetch_status)
+                    fetch.join(0.5)
+                yield (
                     lpp.status,
                     gr.update(
                         choices=models,
                         value=prompts_format if prompts_format in models
                         else models[0]
-                    )
+                    ),
+                    lpp.fetch_status
                 )
 
             for panel in self.query_panels.values():
                 panel.send_btn.click(
                     send_request_click,
                     [source, prompts_format, *panel.params],
-                    [status_bar, prompts_format],
-                    show_progress="full"
+                    [status_bar, prompts_format, panel.progress_info],
+                    show_progress="minimal"
+                )
+                panel.stop_btn.click(
+                    lpp.cancel_request,
+                    [],
+                    [],
+                    show_progress="hidden",
+                    queue=False
+                )
+
+            # Query Params Refresh
+            extra_params = {
+                control: get_values_func
+                for panel in self.query_panels.values()
+                for control, get_values_func in panel.extra_params.items()
+            }
+            params_revision.change(
+                lambda: [gr.update(choices=x()) for x in extra_params.values()],
+                [],
+                list(extra_params),
+                show_progress="hidden"
+            )
+
+            # Queue Buttons
+            def queue_request_click(source, name, filters, *params):
+                lpp.try_queue_request(source, name, filters, *params)
+                return lpp.jobs_markdown
+
+            for panel in self.query_panels.values():
+                panel.queue_btn.click(
+                    queue_request_click,
+                    [source, panel.queue_name, filters, *panel.params],
+                    [jobs_info],
+                    show_progress="hidden"
                 )
 
+            cancel_jobs_btn.click(
+                lpp.cancel_jobs,
+                [],
+                [],
+                show_progress="hidden",
+                queue=False
+            )
+
             # Source Radio Change
             source.change(
                 lambda s: [
@@ -482,8 +646,10 @@ class Scripts(scripts.Script):
 
             # Save Button Click
             def save_prompts_click(name, filters):
+                dedup_threshold = get_opt("lpp_dedup_threshold", 0) \
+                    if get_opt("lpp_dedup_on_save", False) else None
                 pm_dialog.set_action(
-                    lambda: lpp.try_save_prompts(name, filters),
+                    lambda: lpp.try_save_prompts(name, filters, dedup_threshold),
                     name
                 )
                 if name in lpp.prompt_collections:
@@ -494,7 +660,7 @@ class Scripts(scripts.Script):
                         gr.update(visible=True)
                     )
                 else:
-                    lpp.try_save_prompts(name, filters)
+                    lpp.try_save_prompts(name, filters, dedup_threshold)
                     return (
                         gr.Dropdown.update(
                             choices=lpp.prompt_collections
@@ -542,6 +708,61 @@ class Scripts(scripts.Script):
                 show_progress="hidden"
             )
 
+            # Select From Loaded Prompts Button Click
+            def select_prompts_click(query):
+                lpp.try_select_prompts(query)
+                return lpp.status
+
+            select_prompts_btn.click(
+                select_prompts_click,
+                [local_query],
+                [status_bar],
+                show_progress="hidden"
+            )
+
+            # Combine Collections Button Click
+            def combine_click(names, operation):
+                lpp.try_combine_prompts(operation.lower(), names)
+                return (
+                    lpp.status,
+                    gr.Dropdown.update(choices=lpp.prompt_collections)
+                )
+
+            combine_btn.click(
+                combine_click,
+                [combine_collections, combine_operation],
+                [status_bar, combine_collections],
+                show_progress="hidden"
+            )
+
+            # Mix Collections Button Click
+            def mix_click(names, weights, current_model):
+                if not weights.strip():
+                    weights = [1] * len(names or [])
+                else:
+                    try:
+                        weights = [float(x) for x in weights.split(",")]
+                    except ValueError:
+                        weights = []  # reported as a weights count mismatch
+                lpp.try_load_mix(names, weights)
+                models = ["Auto"] + lpp.supported_models
+                return (
+                    lpp.status,
+                    gr.update(
+                        choices=models,
+                        value=current_model if current_model in models
+                        else models[0]
+                    ),
+                    gr.Dropdown.update(choices=lpp.prompt_collections)
+                )
+
+            mix_btn.click(
+                mix_click,
+                [mix_collections, mix_weights, prompts_format],
+                [status_bar, prompts_format, mix_collections],
+                show_progress="hidden"
+            )
+
             # Delete Button Click
             def delete_click(name):
                 pm_dialog.set_action(lambda: lpp.try_delete_prompts(name), "")
@@ -661,7 +882,38 @@ class Scripts(scripts.Script):
         if quick_filter:
             filters += [FilterData.from_string(quick_filter, ",")]
 
-        chosen_prompts = lpp.try_choose_prompts(n_images, allowed_ratings)
+        seed = None
+        if get_opt("lpp_seeded_prompts", False):
+            seeds = getattr(p, "all_seeds", None) or [p.seed]
+            seed = int(seeds[0]) if seeds[0] != -1 else None
+
+        stratify_by = get_opt("lpp_stratify_by", "None")
+        stratify_by = stratify_by if stratify_by != "None" else None
+        dedup_threshold = get_opt("lpp_dedup_threshold", 0)
+        balance = get_opt("lpp_stratify_balance", "uniform")
+        chosen_prompts = lpp.try_choose_prompts(
+            n_images, allowed_ratings,
+            dedup_threshold=dedup_threshold,
+            stratify_by=stratify_by,
+            balance=balance,
+            seed=seed
+        )
+        if seed is not None:
+            # with the collection version, seed, selection options and the
+            # image's index in the batch, its prompt can be looked up again
+            # at any time
+            p.extra_generation_params.update({
+                "LPP Collection": lpp.collection_name,
+                "LPP Version": lpp.collection_version,
+                "LPP Seed": seed,
+                # called by A1111 for every image's infotext
+                "LPP Index": lambda iteration=0, position_in_batch=0, **_:
+                    iteration * p.batch_size + position_in_batch,
+                "LPP Ratings": ", ".join(allowed_ratings or []) or None,
+                "LPP Dedup": dedup_threshold or None,
+                "LPP Stratify": stratify_by,
+                "LPP Balance": balance if stratify_by else None
+            })
         p.all_prompts = chosen_prompts\
             .apply_formatting(prompts_format)\
             .extra_tag_formatting(